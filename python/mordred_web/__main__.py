@@ -1,19 +1,33 @@
 import os
 import sys
+import shutil
 import signal
 import socket
+import secrets
 import argparse
+import tempfile
+import importlib
 import webbrowser
 from contextlib import closing
 
 import psutil
 import tornado.web
+import tornado.netutil
 
-from .db import connect
-from .task_queue import TaskQueue
-from .handler.app import AppInfoHandler
-from .handler.calc import CalcIdHandler, CalcIdExtHandler
-from .handler.file import FileHandler, FileIdHandler, FileIdExtHandler, FileIdNthExtHandler
+from .db import MOL_CODECS, connect
+from .lru import LRUCache
+from .conformer import ConformerCache
+from .export import ExportCache
+from .warmup import warm_up, wait_ready
+from .retention import Retention
+from .schedule import SCHEDULES, CostModel
+from .frontend import RenderPool, SchedulerProxy, fork_processes
+from . import remote
+from .task_queue import TaskQueue, RecyclingExecutor
+from .handler.app import ReadyHandler, MetricsHandler, AppInfoHandler
+from .handler.calc import CalcIdHandler, CalcIdExtHandler, CalcIdProfileHandler
+from .handler.file import (FileHandler, FileIdHandler, FileIdExtHandler, FileIdGridHandler,
+                           FileIdNthExtHandler)
 from .handler.descriptor import DescriptorHandler
 from .handler.singlefile import SingleFileHandler
 
@@ -35,18 +49,33 @@ class Shutdown(object):
 
 
 class MyApplication(tornado.web.Application):
-    def __init__(self, queue, conn, file_size_limit, molecule_limit,
-                 parse_timeout, prepare_timeout, calc_timeout, *args,
-                 **kwargs):
+    def __init__(self, queue, conn, export_cache, image_cache, conformer_cache,
+                 file_size_limit, decompressed_size_limit, molecule_limit, parse_timeout,
+                 prepare_timeout, calc_timeout, embed_threads, split_atoms, split_parts, proxy=None,
+                 transport="pickle", batch_size=1, schedule="file",
+                 *args, **kwargs):
         """Application."""
         super(MyApplication, self).__init__(*args, **kwargs)
         self.queue = queue
+        self.proxy = proxy
+        self.retention = None
+        self.descriptor_info = None
         self.db = conn
+        self.export_cache = export_cache
+        self.image_cache = image_cache
+        self.conformer_cache = conformer_cache
         self.file_size_limit = file_size_limit
+        self.decompressed_size_limit = decompressed_size_limit
         self.parse_timeout = parse_timeout
         self.prepare_timeout = prepare_timeout
         self.molecule_limit = molecule_limit
         self.calc_timeout = calc_timeout
+        self.embed_threads = embed_threads
+        self.split_atoms = split_atoms
+        self.split_parts = split_parts
+        self.transport = transport
+        self.batch_size = batch_size
+        self.cost_model = CostModel(conn) if schedule == "lpt" else None
 
 
 def get_free_address(lower=3000):
@@ -63,15 +92,98 @@ def get_free_address(lower=3000):
         raise OSError("no free port")
 
 
+def make_app(queue, conn, cache, image_cache_size, conformer_cache_size, proxy=None,
+             **options):
+    static = os.path.join(os.path.dirname(__file__), "static")
+
+    return MyApplication(
+        queue=queue,
+        conn=conn,
+        proxy=proxy,
+        export_cache=ExportCache(cache),
+        image_cache=LRUCache(image_cache_size * MEGA),
+        conformer_cache=(ConformerCache(conn, conformer_cache_size)
+                         if conformer_cache_size > 0 else None),
+        handlers=[
+            (r"/api/descriptor", DescriptorHandler),
+            (r"/api/info", AppInfoHandler),
+            (r"/api/ready", ReadyHandler),
+            (r"/metrics", MetricsHandler),
+            (r"/api/file", FileHandler),
+            (r"/api/file/([0-9a-zA-Z]+)", FileIdHandler),
+            (r"/api/file/([0-9a-zA-Z]+)\.(.*)", FileIdExtHandler),
+            (r"/api/file/([0-9a-zA-Z]+)/([0-9]+)\.(.*)",
+             FileIdNthExtHandler),
+            (r"/api/file/([0-9a-zA-Z]+)/([0-9]+)-([0-9]+)\.(.*)",
+             FileIdGridHandler),
+            (r"/api/calc/([0-9a-zA-Z]+)", CalcIdHandler),
+            (r"/api/calc/([0-9a-zA-Z]+)/profile", CalcIdProfileHandler),
+            (r"/api/calc/([0-9a-zA-Z]+)\.(.*)", CalcIdExtHandler, {
+                "path": cache,
+            }),
+            (r"/static/(.*)", tornado.web.StaticFileHandler, {
+                "path": static,
+            }),
+            (r"/.*", SingleFileHandler, {
+                "path": os.path.join(static, "index.html"),
+            }),
+        ],
+        compress_response=True,
+        static_hash_cache=True,
+        **options)
+
+
+def start_retention(app, db, ttl, max_size, interval):
+    if ttl is None and max_size is None:
+        return
+
+    # the retention thread writes through a connection of its own
+    app.db.execute("PRAGMA journal_mode = WAL")
+    app.retention = Retention(
+        db, app.db, app.queue, app.export_cache, ttl=ttl, max_size=max_size)
+    tornado.ioloop.PeriodicCallback(app.retention.run, interval * 1000).start()
+
+
+def run(server, ioloop, url, no_browser):
+    if not no_browser:
+        webbrowser.open(url, autoraise=True)
+
+    signal.signal(signal.SIGTERM, Shutdown(server, ioloop))
+    signal.signal(signal.SIGINT, Shutdown(server, ioloop))
+    print("start mordred.web on {}".format(url))  # noqa: T003
+    ioloop.start()
+
+
 def serve(port,
           workers,
           no_browser,
           file_size_limit=3,
+          decompressed_size_limit=50,
           molecule_limit=50,
           parse_timeout=60,
           prepare_timeout=60,
           calc_timeout=60,
-          db="mordred-web.sqlite"):
+          db="mordred-web.sqlite",
+          cache="mordred-web-cache",
+          image_cache_size=64,
+          conformer_cache_size=10000,
+          embed_threads=1,
+          split_atoms=0,
+          split_parts=None,
+          transport="pickle",
+          batch_size=16,
+          schedule="file",
+          frontends=1,
+          render_workers=1,
+          remote_workers=None,
+          worker_token="",
+          retention_days=None,
+          max_db_size=None,
+          retention_interval=60,
+          mol_codec="raw",
+          max_jobs_per_worker=None,
+          worker_memory_limit=None,
+          warmup=True):
 
     if port is None:
         _, port = get_free_address()
@@ -79,53 +191,124 @@ def serve(port,
     if workers is None:
         workers = psutil.cpu_count(logical=False)
 
-    static = os.path.join(os.path.dirname(__file__), "static")
+    if split_parts is None:
+        split_parts = workers
+
+    options = {
+        "batch_size": batch_size,
+        "calc_timeout": calc_timeout,
+        "decompressed_size_limit": decompressed_size_limit,
+        "embed_threads": embed_threads,
+        "file_size_limit": file_size_limit,
+        "molecule_limit": molecule_limit,
+        "parse_timeout": parse_timeout,
+        "prepare_timeout": prepare_timeout,
+        "schedule": schedule,
+        "split_atoms": split_atoms,
+        "split_parts": split_parts,
+        "transport": transport,
+    }
+    max_body_size = (file_size_limit + 1) * MEGA
+    retention = {
+        "interval": retention_interval,
+        "max_size": None if max_db_size is None else max_db_size * MEGA,
+        "ttl": None if retention_days is None else retention_days * 24 * 60 * 60,
+    }
+    url = "http://127.0.0.1:{}".format(port)
+
+    if remote_workers is not None and not worker_token:
+        # workers are sent pickles, so they are never accepted without a token
+        worker_token = secrets.token_urlsafe(24)
+        print("worker token: {}".format(worker_token))  # noqa: T003
+
+    def task_queue(ioloop):
+        initializer = warm_up if warmup else None
+        if remote_workers is not None:
+            executor = remote.RemoteExecutor(remote_workers, token=worker_token)
+            print("accept workers on {}:{}".format(*executor.address[:2]))  # noqa: T003
+        elif max_jobs_per_worker is not None or worker_memory_limit is not None:
+            executor = RecyclingExecutor(
+                workers, max_jobs=max_jobs_per_worker,
+                max_memory=None if worker_memory_limit is None else worker_memory_limit * MEGA,
+                initializer=initializer)
+        else:
+            executor = None
+
+        queue = TaskQueue(workers, ioloop, executor=executor, initializer=initializer)
+        if warmup:
+            ioloop.spawn_callback(wait_ready, queue, workers)
+        else:
+            queue.ready = True
+
+        return queue
+
+    if frontends <= 1:
+        ioloop = tornado.ioloop.IOLoop.current()
+        with connect(db, mol_codec=mol_codec) as conn, task_queue(ioloop) as queue:
+            app = make_app(queue, conn, cache, image_cache_size, conformer_cache_size, **options)
+            start_retention(app, db, **retention)
+            server = tornado.httpserver.HTTPServer(app, max_body_size=max_body_size)
+            server.bind(port)
+            server.start(1)
+            run(server, ioloop, url, no_browser)
+
+        return
+
+    # one scheduler owning the task queue and database writes, and front ends
+    # serving reads and forwarding writes to it over a unix socket
+    sockets = tornado.netutil.bind_sockets(port)
+    with connect(db) as conn:
+        conn.execute("PRAGMA journal_mode = WAL")
+
+    sock_dir = tempfile.mkdtemp(prefix="mordred-web-")
+    path = os.path.join(sock_dir, "scheduler.sock")
+    scheduler = tornado.netutil.bind_unix_socket(path)
+
+    i = fork_processes(frontends + 1)
+    if i is None:
+        shutil.rmtree(sock_dir, ignore_errors=True)
+        return
+
     ioloop = tornado.ioloop.IOLoop.current()
+    if i == 0:
+        for sock in sockets:
+            sock.close()
+
+        with connect(db, mol_codec=mol_codec) as conn, task_queue(ioloop) as queue:
+            app = make_app(queue, conn, cache, image_cache_size, conformer_cache_size, **options)
+            start_retention(app, db, **retention)
+            server = tornado.httpserver.HTTPServer(app, max_body_size=max_body_size)
+            server.add_socket(scheduler)
+            run(server, ioloop, "unix:{}".format(path), True)
+
+        return
 
-    with connect(db) as conn, TaskQueue(workers, ioloop) as queue:
-        app = MyApplication(
-            queue=queue,
-            conn=conn,
-            file_size_limit=file_size_limit,
-            molecule_limit=molecule_limit,
-            parse_timeout=parse_timeout,
-            prepare_timeout=prepare_timeout,
-            calc_timeout=calc_timeout,
-            handlers=[
-                (r"/api/descriptor", DescriptorHandler),
-                (r"/api/info", AppInfoHandler),
-                (r"/api/file", FileHandler),
-                (r"/api/file/([0-9a-zA-Z]+)", FileIdHandler),
-                (r"/api/file/([0-9a-zA-Z]+)\.(.*)", FileIdExtHandler),
-                (r"/api/file/([0-9a-zA-Z]+)/([0-9]+)\.(.*)",
-                 FileIdNthExtHandler),
-                (r"/api/calc/([0-9a-zA-Z]+)", CalcIdHandler),
-                (r"/api/calc/([0-9a-zA-Z]+)\.(.*)", CalcIdExtHandler),
-                (r"/static/(.*)", tornado.web.StaticFileHandler, {
-                    "path": static,
-                }),
-                (r"/.*", SingleFileHandler, {
-                    "path": os.path.join(static, "index.html"),
-                }),
-            ],
-            compress_response=True,
-            static_hash_cache=True)
-        server = tornado.httpserver.HTTPServer(
-            app, max_body_size=(file_size_limit + 1) * MEGA)
-        server.bind(port)
-        server.start(1)
-        url = "http://127.0.0.1:{}".format(port)
-        if not no_browser:
-            webbrowser.open(url, autoraise=True)
-
-        signal.signal(signal.SIGTERM, Shutdown(server, ioloop))
-        signal.signal(signal.SIGINT, Shutdown(server, ioloop))
-        print("start mordred.web on {}".format(url))  # noqa: T003
-        ioloop.start()
+    scheduler.close()
+    with connect(db, readonly=True) as conn, RenderPool(render_workers) as queue:
+        app = make_app(queue, conn, cache, image_cache_size, 0,
+                       proxy=SchedulerProxy(path), **options)
+        server = tornado.httpserver.HTTPServer(app, max_body_size=max_body_size)
+        server.add_sockets(sockets)
+        run(server, ioloop, url, no_browser or i != 1)
+
+
+# modules of the subcommands, imported only when run
+SUBCOMMANDS = {
+    "batch": ".batch",
+    "bench": ".bench",
+    "loadtest": ".loadtest",
+    "worker": ".remote",
+}
 
 
 def main():
-    parser = argparse.ArgumentParser(description="Mordred Web UI")
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        module = importlib.import_module(SUBCOMMANDS[sys.argv[1]], __package__)
+        return module.main(sys.argv[2:])
+
+    parser = argparse.ArgumentParser(
+        description="Mordred Web UI",
+        epilog="subcommands: {} (see <subcommand> --help)".format(", ".join(sorted(SUBCOMMANDS))))
     parser.add_argument("-p", "--port", type=int, default=None, help="port")
     parser.add_argument(
         "-w", "--workers", type=int, default=None, help="number of workers")
@@ -135,6 +318,12 @@ def main():
         type=int,
         default=5,
         help="upload file size limit")
+    parser.add_argument(
+        "--decompressed-size-limit",
+        metavar="MB",
+        type=int,
+        default=50,
+        help="size limit of compressed (.gz, .bz2, .xz) and zip uploads after decompression")
     parser.add_argument(
         "--molecule-limit",
         metavar="N",
@@ -165,12 +354,139 @@ def main():
         type=str,
         default="mordred-web.sqlite",
         help="database file path")
+    parser.add_argument(
+        "--cache",
+        metavar="DIR",
+        type=str,
+        default="mordred-web-cache",
+        help="export file cache directory")
+    parser.add_argument(
+        "--image-cache-size",
+        metavar="MB",
+        type=int,
+        default=64,
+        help="structure image cache size")
+    parser.add_argument(
+        "--conformer-cache-size",
+        metavar="N",
+        type=int,
+        default=10000,
+        help="number of cached 3D conformers (0 to disable)")
+    parser.add_argument(
+        "--embed-threads",
+        metavar="N",
+        type=int,
+        default=1,
+        help="threads per worker for multi-conformer embedding (0 to use all cores)")
+    parser.add_argument(
+        "--split-atoms",
+        metavar="N",
+        type=int,
+        default=0,
+        help="split descriptors of molecules with at least N atoms across workers (0 to disable)")
+    parser.add_argument(
+        "--split-parts",
+        metavar="N",
+        type=int,
+        default=None,
+        help="number of parts to split a molecule into (default: number of workers)")
+    parser.add_argument(
+        "--transport",
+        choices=["pickle", "shm"],
+        default="pickle",
+        help="how calc jobs reach local workers: a pickled molecule per job, or batches of "
+        "molecules and their results in shared memory")
+    parser.add_argument(
+        "--batch-size",
+        metavar="N",
+        type=int,
+        default=16,
+        help="molecules per calc job with --transport shm; the calc timeout applies per "
+        "molecule")
+    parser.add_argument(
+        "--schedule",
+        choices=SCHEDULES,
+        default="file",
+        help="order of calc and 3D preparation jobs: file order, or longest processing time "
+        "first by a cost estimate of heavy atoms, rings and rotatable bonds, refit to "
+        "profiled jobs")
+    parser.add_argument(
+        "--frontends",
+        metavar="N",
+        type=int,
+        default=1,
+        help="number of HTTP front end processes; more than 1 adds a scheduler process")
+    parser.add_argument(
+        "--render-workers",
+        metavar="N",
+        type=int,
+        default=1,
+        help="workers per front end for rendering and exports (with --frontends)")
+    parser.add_argument(
+        "--remote-workers",
+        metavar="HOST:PORT",
+        type=str,
+        default=None,
+        help="run jobs on `worker` nodes connecting to HOST:PORT instead of local processes; "
+        "--workers sets the number of concurrent jobs. Jobs and results are pickles, so keep "
+        "HOST:PORT on a trusted network")
+    parser.add_argument(
+        "--worker-token",
+        metavar="TOKEN",
+        type=str,
+        default="",
+        help="token remote workers must present (default: a random token, printed at start)")
+    parser.add_argument(
+        "--retention-days",
+        metavar="DAYS",
+        type=float,
+        default=None,
+        help="delete files and their calcs older than DAYS")
+    parser.add_argument(
+        "--max-db-size",
+        metavar="MB",
+        type=int,
+        default=None,
+        help="delete the oldest files while the database is larger than MB")
+    parser.add_argument(
+        "--retention-interval",
+        metavar="SEC",
+        type=int,
+        default=60,
+        help="interval of retention and incremental vacuum, run while the queue is idle")
+    parser.add_argument(
+        "--mol-codec",
+        choices=sorted(MOL_CODECS),
+        default="raw",
+        help="compression of stored molecules; zstd requires zstandard "
+        "(see `bench codec`)")
+    parser.add_argument(
+        "--max-jobs-per-worker",
+        metavar="N",
+        type=int,
+        default=None,
+        help="replace a worker process after it has run N jobs")
+    parser.add_argument(
+        "--worker-memory-limit",
+        metavar="MB",
+        type=int,
+        default=None,
+        help="replace a worker process when its resident memory exceeds MB after a job")
+    parser.add_argument(
+        "--no-warmup",
+        dest="warmup",
+        action="store_false",
+        help="don't warm up worker processes before they take jobs; "
+        "/api/info reports ready at once")
     parser.add_argument(
         "--no-browser",
         action="store_true",
         default=False,
         help="don't open browser automatically")
     result = (parser.parse_args())
+    if result.transport == "shm" and result.remote_workers is not None:
+        parser.error("--transport shm requires local workers")
+
     serve(**vars(result))
 
 
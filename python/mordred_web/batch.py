@@ -0,0 +1,263 @@
+"""Calculate descriptors of a molecule file without running the server.
+
+Molecules are read as a stream and processed in chunks on a worker pool,
+using the same preparation and calculation jobs as the server. Each chunk
+is saved as a part file as soon as it is done, so an interrupted run resumes
+from its last finished chunk; the output is written from the parts at the
+end.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+from concurrent.futures import FIRST_COMPLETED, wait
+
+import numpy as np
+from loky import ProcessPoolExecutor
+from mordred.error import MissingValueBase
+
+from .export import (pyarrow, ARROW_EXTS, csv_chunks, npz_chunks, arrow_chunks,
+                     parquet_chunks)
+from .handler.calc import CalcWorker, PrepareWorker
+from .handler.file import (READERS, DECOMPRESSORS, DEFAULT_EMBED, EMBED_METHODS, MAX_CONFORMERS,
+                           PrepareJob, get_reader, open_input)
+
+WRITERS = {
+    "arrow": arrow_chunks,
+    "csv": csv_chunks,
+    "npz": npz_chunks,
+    "parquet": parquet_chunks,
+}
+
+
+def iter_chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+class ChunkJob(object):
+    """Prepare and calculate a chunk of molecules in one worker.
+
+    mols are (mol, name) pairs as yielded by the readers, where mol is an
+    exception for unparsable records.
+    """
+
+    def __init__(self, index, mols, calc, gen3D, desalt, embed):
+        self.index = index
+        self.mols = mols
+        self.calc = calc
+        self.gen3D = gen3D
+        self.desalt = desalt
+        self.embed = embed
+
+    def __call__(self):
+        names, rows, errors = [], [], []
+        missing = [np.nan] * len(self.calc.descriptors)
+
+        for nth, (mol, name) in enumerate(self.mols):
+            if isinstance(mol, Exception):
+                errors.append(str(mol))
+                continue
+
+            name = name.strip()
+            try:
+                _, mol, _, _, _ = PrepareJob(
+                    mol, nth, name, self.gen3D, self.desalt, embed=self.embed)()
+            except Exception as e:
+                errors.append("{}: prepare: {}".format(name, str(e) or repr(e)))
+                continue
+
+            names.append(name)
+            try:
+                result = CalcWorker(mol, nth, self.calc, None)()
+            except Exception as e:
+                errors.append("{}: {}".format(name, str(e) or repr(e)))
+                rows.append(missing)
+                continue
+
+            rows.append([np.nan if isinstance(v, MissingValueBase) else v for v in result])
+
+        values = np.array(rows, dtype=np.float64).reshape(len(rows), len(missing))
+        return self.index, names, values, np.isnan(values), errors
+
+
+class Checkpoint(object):
+    """Directory of finished chunks of a batch run."""
+
+    def __init__(self, path, manifest):
+        self.path = path
+        manifest_path = os.path.join(path, "manifest.json")
+
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                if json.load(f) != manifest:
+                    raise ValueError(
+                        "checkpoint {} belongs to another run; remove it or choose another "
+                        "--checkpoint".format(path))
+        else:
+            os.makedirs(path, exist_ok=True)
+            with open(manifest_path, "w") as f:
+                json.dump(manifest, f, sort_keys=True)
+
+    def part(self, index):
+        return os.path.join(self.path, "{:08d}.npz".format(index))
+
+    def done(self, index):
+        return os.path.exists(self.part(index))
+
+    def save(self, index, names, values, mask, errors):
+        tmp = self.part(index) + ".tmp"
+        with open(tmp, "wb") as f:
+            np.savez(
+                f,
+                names=np.array(names, dtype=str),
+                values=values,
+                mask=mask,
+                errors=np.array(errors, dtype=str))
+
+        os.rename(tmp, self.part(index))
+
+    def parts(self):
+        for name in sorted(os.listdir(self.path)):
+            if name.endswith(".npz"):
+                with np.load(os.path.join(self.path, name)) as part:
+                    yield part["names"].tolist(), part["values"], part["mask"], \
+                        part["errors"].tolist()
+
+    def total(self):
+        return sum(len(names) for names, _, _, _ in self.parts())
+
+    def remove(self):
+        shutil.rmtree(self.path)
+
+
+def run(args):
+    ext = os.path.splitext(args.output)[1].lstrip(".").lower()
+    if ext not in WRITERS:
+        raise ValueError("unknown output format: {}".format(ext))
+
+    if ext in ARROW_EXTS and pyarrow is None:
+        raise ValueError("{} output requires pyarrow".format(ext))
+
+    if get_reader(args.input)[0] is None:
+        raise ValueError("unknown input format: {}".format(args.input))
+
+    calc, unknown = PrepareWorker(set(args.disabled), set(args.descriptor))()
+    for name in unknown:
+        print("unknown descriptor: {}".format(name), file=sys.stderr)  # noqa: T003
+
+    descriptors = [str(d) for d in calc.descriptors]
+    embed = {"conformers": args.conformers, "method": args.embed, "seed": args.seed}
+
+    stat = os.stat(args.input)
+    checkpoint = Checkpoint(args.checkpoint or args.output + ".parts", {
+        "chunk_size": args.chunk_size,
+        "desalt": args.desalt,
+        "descriptors": descriptors,
+        "embed": embed,
+        "gen3D": args.gen3D,
+        "input": os.path.abspath(args.input),
+        "mtime": stat.st_mtime,
+        "size": stat.st_size,
+    })
+
+    start, done = time.time(), 0
+
+    def collect(futures):
+        nonlocal done
+        for fut in futures:
+            index, names, values, mask, errors = fut.result()
+            checkpoint.save(index, names, values, mask, errors)
+            done += len(names)
+            print("chunk {}: {} molecules, {:.1f} molecules/s".format(  # noqa: T003
+                index, len(names), done / (time.time() - start)), file=sys.stderr)
+
+    with open(args.input, "rb") as f, ProcessPoolExecutor(args.workers) as pool:
+        reader, f = open_input(f, args.input)
+        running = set()
+        for index, chunk in enumerate(iter_chunks(reader(f), args.chunk_size)):
+            if checkpoint.done(index):
+                continue
+
+            if len(running) >= 2 * args.workers:
+                finished, running = wait(running, return_when=FIRST_COMPLETED)
+                collect(finished)
+
+            running.add(pool.submit(ChunkJob(
+                index, chunk, calc, args.gen3D, args.desalt, embed)))
+
+        collect(wait(running).done)
+
+    tmp = args.output + ".tmp"
+    batches = ((names, values, mask) for names, values, mask, _ in checkpoint.parts())
+    with open(tmp, "wb") as f:
+        for chunk in WRITERS[ext](descriptors, checkpoint.total(), batches):
+            f.write(chunk)
+
+    os.rename(tmp, args.output)
+
+    errors = [e for _, _, _, errors in checkpoint.parts() for e in errors]
+    if errors:
+        with open(args.output + ".errors.txt", "w") as f:
+            f.writelines(e + "\n" for e in errors)
+
+    if not args.keep_checkpoint:
+        checkpoint.remove()
+
+    return errors
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog="mordred_web batch", description="Calculate descriptors of a molecule file")
+    parser.add_argument(
+        "input", help="input file ({}), optionally compressed ({})".format(
+            ", ".join(sorted(READERS)), ", ".join(sorted(DECOMPRESSORS))))
+    parser.add_argument(
+        "-o", "--output", required=True,
+        help="output file ({})".format(", ".join("." + e for e in sorted(WRITERS))))
+    parser.add_argument(
+        "-w", "--workers", type=int, default=os.cpu_count(), help="number of workers")
+    parser.add_argument(
+        "--chunk-size", metavar="N", type=int, default=500, help="molecules per job")
+    parser.add_argument(
+        "--checkpoint", metavar="DIR", default=None,
+        help="directory of finished chunks (default: OUTPUT.parts)")
+    parser.add_argument(
+        "--keep-checkpoint", action="store_true", help="keep finished chunks after the run")
+    parser.add_argument("--gen3D", action="store_true", help="generate 3D conformers")
+    parser.add_argument(
+        "--no-desalt", dest="desalt", action="store_false", help="keep all fragments")
+    parser.add_argument(
+        "--embed", choices=sorted(EMBED_METHODS), default=DEFAULT_EMBED["method"],
+        help="3D embedding method")
+    parser.add_argument("--seed", type=int, default=DEFAULT_EMBED["seed"], help="embedding seed")
+    parser.add_argument(
+        "--conformers", type=int, choices=range(1, MAX_CONFORMERS + 1), metavar="N",
+        default=DEFAULT_EMBED["conformers"], help="conformers to embed, keeping the lowest energy")
+    parser.add_argument(
+        "--disabled", metavar="MODULE", action="append", default=[],
+        help="disable a descriptor module")
+    parser.add_argument(
+        "--descriptor", metavar="NAME", action="append", default=[],
+        help="calculate only the named descriptors")
+    args = parser.parse_args(args)
+
+    try:
+        errors = run(args)
+    except ValueError as e:
+        parser.exit(1, "{}\n".format(e))
+
+    if errors:
+        print("{} errors written to {}.errors.txt".format(  # noqa: T003
+            len(errors), args.output), file=sys.stderr)
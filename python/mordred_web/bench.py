@@ -0,0 +1,415 @@
+"""Benchmarks of mordred-web internals."""
+
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+import urllib.error
+import urllib.parse
+import urllib.request
+from importlib import metadata
+
+from rdkit import Chem
+
+from .db import MOL_CODECS, zstandard, decode_mol, encode_mol
+from .handler.file import gen3D, open_input
+
+
+def load_mols(path, embed=False):
+    with open(path, "rb") as f:
+        reader, f = open_input(f, path)
+        mols = [mol for mol, _ in reader(f) if isinstance(mol, Chem.Mol)]
+
+    if embed:
+        embedded = []
+        for mol in mols:
+            try:
+                embedded.append(gen3D(mol)[1])
+            except ValueError:
+                pass
+
+        mols = embedded
+
+    return mols
+
+
+def bench_codec(args):
+    """Compare size, encode and decode time of the molecule blob codecs."""
+    mols = load_mols(args.input, args.gen3D)
+    blobs = [m.ToBinary() for m in mols]
+    raw = sum(len(b) for b in blobs)
+
+    print("{} molecules, {} bytes raw".format(len(blobs), raw))  # noqa: T003
+    print("{:<6} {:>10} {:>7} {:>12} {:>12}".format(  # noqa: T003
+        "codec", "bytes", "ratio", "encode us", "decode us"))
+
+    for codec in sorted(MOL_CODECS):
+        if codec == "zstd" and zstandard is None:
+            print("{:<6} (zstandard is not installed)".format(codec))  # noqa: T003
+            continue
+
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            encoded = [encode_mol(b, codec) for b in blobs]
+        encode = (time.perf_counter() - start) / args.repeat / len(blobs)
+
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for b in encoded:
+                Chem.Mol(decode_mol(b))
+        decode = (time.perf_counter() - start) / args.repeat / len(blobs)
+
+        size = sum(len(b) for b in encoded)
+        print("{:<6} {:>10} {:>7.3f} {:>12.1f} {:>12.1f}".format(  # noqa: T003
+            codec, size, size / raw, encode * 1e6, decode * 1e6))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class Server(object):
+    """Server subprocess with a temporary database and cache."""
+
+    def __init__(self, workers, server_args=(), timeout=120):
+        self.workers = workers
+        self.server_args = [a for a in server_args if a != "--"]
+        self.timeout = timeout
+
+    def __enter__(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        port = free_port()
+        self.base = "http://127.0.0.1:{}".format(port)
+        self.started = time.perf_counter()
+        self.proc = subprocess.Popen(
+            [sys.executable, "-m", __package__, "--no-browser", "-p", str(port),
+             "-w", str(self.workers), "--db", os.path.join(self.tmp.name, "db.sqlite"),
+             "--cache", os.path.join(self.tmp.name, "cache")] + self.server_args,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return self
+
+    def __exit__(self, *args):
+        self.proc.terminate()
+        self.proc.wait()
+        self.tmp.cleanup()
+
+    def wait(self, path):
+        """Wait until path answers 200, returning the seconds since the start."""
+        start = time.perf_counter()
+        while time.perf_counter() - start < self.timeout:
+            if self.proc.poll() is not None:
+                raise RuntimeError("server exited with status {}".format(self.proc.returncode))
+
+            try:
+                self.request(path)
+                return time.perf_counter() - self.started
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.01)
+
+        raise RuntimeError("{} did not answer in {}s".format(path, self.timeout))
+
+    def request(self, path, data=None, headers=None):
+        req = urllib.request.Request(self.base + path, data=data, headers=headers or {})
+        with urllib.request.urlopen(req, timeout=self.timeout) as r:
+            return r.read()
+
+    def json(self, path, data=None):
+        return json.loads(self.request(path, data, {"Accept": "application/json"}))
+
+    def upload(self, path, **params):
+        boundary = uuid.uuid4().hex
+        with open(path, "rb") as f:
+            body = b"".join([
+                "--{}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{}\"\r\n"
+                "Content-Type: application/octet-stream\r\n\r\n".format(
+                    boundary, os.path.basename(path)).encode("UTF-8"),
+                f.read(),
+                "\r\n--{}--\r\n".format(boundary).encode("UTF-8"),
+            ])
+
+        return json.loads(self.request(
+            "/api/file?" + urllib.parse.urlencode(params), body,
+            {"Content-Type": "multipart/form-data; boundary=" + boundary}))
+
+    def poll(self, path, done):
+        start = time.perf_counter()
+        while time.perf_counter() - start < self.timeout:
+            result = self.json(path)
+            if done(result):
+                return result
+
+            time.sleep(0.05)
+
+        raise RuntimeError("{} did not finish in {}s".format(path, self.timeout))
+
+    def metrics(self):
+        values = {}
+        for line in self.request("/metrics").decode("UTF-8").splitlines():
+            if line and not line.startswith("#"):
+                name, value = line.rsplit(" ", 1)
+                values[name] = float(value)
+
+        return values
+
+
+def start_server(args):
+    """Start a server, returning the seconds until it listens, is ready and answers.
+
+    The last is the first answer of /api/descriptor.
+    """
+    with Server(args.workers, args.server_args, args.timeout) as server:
+        return [server.wait(path) for path in ["/api/info", "/api/ready", "/api/descriptor"]]
+
+
+def bench_startup(args):
+    """Measure cold start.
+
+    Times are of the import, and until the server listens, is ready and has
+    listed the descriptors.
+    """
+    imports = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        subprocess.check_call(
+            [sys.executable, "-c", "import {}.__main__".format(__package__)])
+        imports.append(time.perf_counter() - start)
+
+    runs = [start_server(args) for _ in range(args.repeat)]
+
+    print("{:<12} {:>8} {:>8} {:>8}".format("seconds", "min", "median", "max"))  # noqa: T003
+    rows = [("import", imports)] + [
+        (name, [r[i] for r in runs]) for i, name in enumerate(["listen", "ready", "descriptor"])]
+    for name, values in rows:
+        print("{:<12} {:>8.3f} {:>8.3f} {:>8.3f}".format(  # noqa: T003
+            name, min(values), statistics.median(values), max(values)))
+
+
+COMMIT_SECONDS = "mordred_web_sqlite_commit_seconds"
+# scale-ups repeat molecules, which must not hit the conformer cache
+SERVER_ARGS = ["--file-size-limit", "64", "--conformer-cache-size", "0"]
+
+
+def scale_smiles(path, n, out):
+    """Write n molecules to out, repeating the SMILES file path with numbered names."""
+    with open(path, "rb") as f:
+        records = [line.split(None, 1) for line in f if line.strip()]
+
+    with open(out, "wb") as f:
+        for i in range(n):
+            fields = records[i % len(records)]
+            name = fields[1].strip() if len(fields) > 1 else fields[0]
+            f.write(b"%s %s_%d\n" % (fields[0], name, i // len(records)))
+
+
+def run_case(server, args, case, path, use_3D):
+    """Upload path, calculate and export it, returning a result per stage."""
+    results = []
+
+    def record(stage, seconds, count, **extra):
+        results.append(dict(
+            case=case, gen3D=use_3D, stage=stage, count=count, seconds=seconds,
+            per_second=count / seconds if seconds > 0 else None, **extra))
+
+    file_id = server.upload(path, gen3D=str(use_3D).lower())["id"]
+    f = server.poll("/api/file/" + file_id, lambda j: j["phase"] in {"done", "error"})
+    if f["phase"] == "error":
+        raise RuntimeError("{}: {}".format(case, "; ".join(f["errors"])))
+
+    n = len(f["mols"])
+    record("parse", f["parse_finished_at"] - f["parse_started_at"], n)
+    record("prepare_3D" if use_3D else "prepare",
+           f["prepare_finished_at"] - f["prepare_started_at"], n)
+
+    start = time.perf_counter()
+    server.request("/api/file/{}.sdf".format(file_id))
+    record("export_sdf", time.perf_counter() - start, n)
+
+    if use_3D or (args.max_calc is not None and n > args.max_calc):
+        return results
+
+    # commits of the calc only, not of the parse and prepare above
+    before = server.metrics()
+    calc_id = json.loads(server.request("/api/calc/" + file_id, b""))["id"]
+    c = server.poll("/api/calc/" + calc_id, lambda j: j["finished_at"] is not None)
+    after = server.metrics()
+    record("calc", c["finished_at"] - c["started_at"], n)
+
+    commits = after[COMMIT_SECONDS + "_count"] - before[COMMIT_SECONDS + "_count"]
+    rows = n * (1 + len(c["descriptors"]))
+    record("db_write", after[COMMIT_SECONDS + "_sum"] - before[COMMIT_SECONDS + "_sum"], rows,
+           commits=int(commits))
+
+    for ext in ["csv", "xlsx"]:
+        start = time.perf_counter()
+        server.request("/api/calc/{}.{}".format(calc_id, ext))
+        record("export_" + ext, time.perf_counter() - start, n)
+
+    return results
+
+
+def environment():
+    def version(name):
+        try:
+            return metadata.version(name)
+        except metadata.PackageNotFoundError:
+            return None
+
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(__file__),
+            stderr=subprocess.DEVNULL).decode("UTF-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        "commit": commit,
+        "cpu_count": os.cpu_count(),
+        "machine": platform.machine(),
+        "mordred": version("mordred"),
+        "python": platform.python_version(),
+        "rdkit": version("rdkit") or version("rdkit-pypi"),
+        "system": platform.system(),
+        "time": time.time(),
+        "tornado": version("tornado"),
+    }
+
+
+def bench_pipeline(args):
+    """Run the example files and SMILES scale-ups through a server.
+
+    The time of each stage is recorded.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmp, \
+            Server(args.workers, SERVER_ARGS + args.server_args, args.timeout) as server:
+        server.wait("/api/ready")
+
+        cases = [("example.smi", os.path.join(args.examples, "example.smi"), [False, True]),
+                 ("example.sdf", os.path.join(args.examples, "example.sdf"), [False])]
+        for n in args.sizes:
+            path = os.path.join(tmp, "scale-{}.smi".format(n))
+            scale_smiles(os.path.join(args.examples, "example.smi"), n, path)
+            modes = [False, True] if n <= args.max_3D else [False]
+            cases.append(("scale-{}".format(n), path, modes))
+
+        for case, path, modes in cases:
+            for use_3D in modes:
+                runs = [run_case(server, args, case, path, use_3D) for _ in range(args.repeat)]
+                for stages in zip(*runs):
+                    result = dict(stages[0], runs=[r["seconds"] for r in stages])
+                    result["seconds"] = statistics.median(result["runs"])
+                    result["per_second"] = result["count"] / result["seconds"] \
+                        if result["seconds"] > 0 else None
+                    results.append(result)
+                    line = "{case:<12} {stage:<11} {count:>9} {seconds:>9.3f}s".format(**result)
+                    print(line, file=sys.stderr)  # noqa: T003
+
+    report = {
+        "args": {"max_3D": args.max_3D, "max_calc": args.max_calc, "repeat": args.repeat,
+                 "sizes": args.sizes, "workers": args.workers},
+        "environment": environment(),
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    print("results written to {}".format(args.output), file=sys.stderr)  # noqa: T003
+
+
+def bench_compare(args):
+    """Compare the stage times of two pipeline results."""
+    def load(path):
+        with open(path) as f:
+            return {(r["case"], r["gen3D"], r["stage"]): r for r in json.load(f)["results"]}
+
+    old, new = load(args.old), load(args.new)
+    regressions = 0
+    print("{:<12} {:<14} {:>9} {:>9} {:>8}".format(  # noqa: T003
+        "case", "stage", "old s", "new s", "change"))
+    for key in sorted(set(old) & set(new), key=str):
+        case, use_3D, stage = key
+        a, b = old[key]["seconds"], new[key]["seconds"]
+        change = (b - a) / a if a > 0 else 0.0
+        slow = change > args.threshold and b >= args.min_seconds
+        regressions += slow
+        print("{:<12} {:<14} {:>9.3f} {:>9.3f} {:>+7.1%}{}".format(  # noqa: T003
+            case, stage + (" 3D" if use_3D else ""), a, b, change, " *" if slow else ""))
+
+    if regressions:
+        print("{} stages slower by more than {:.0%}".format(  # noqa: T003
+            regressions, args.threshold), file=sys.stderr)
+        sys.exit(1)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog="mordred_web bench", description="Mordred Web benchmarks")
+    subparsers = parser.add_subparsers(dest="bench")
+
+    codec = subparsers.add_parser(
+        "codec", help="size and speed of stored molecule codecs (--mol-codec)")
+    codec.add_argument("input", help="molecule file (.smi or .sdf)")
+    codec.add_argument("--gen3D", action="store_true", help="generate 3D conformers first")
+    codec.add_argument("--repeat", type=int, default=10, help="number of repetitions")
+    codec.set_defaults(run=bench_codec)
+
+    startup = subparsers.add_parser(
+        "startup", help="cold start of the server until it listens and is ready")
+    startup.add_argument("--repeat", type=int, default=3, help="number of repetitions")
+    startup.add_argument("-w", "--workers", type=int, default=1, help="number of workers")
+    startup.add_argument(
+        "--timeout", type=float, default=120, help="seconds to wait for each step")
+    startup.add_argument(
+        "server_args", nargs=argparse.REMAINDER, help="further server options, after --")
+    startup.set_defaults(run=bench_startup)
+
+    pipeline = subparsers.add_parser(
+        "pipeline", help="parse, prepare, calc, database and export times, saved as JSON")
+    pipeline.add_argument(
+        "-o", "--output", default="bench-pipeline.json", help="result file (JSON)")
+    pipeline.add_argument(
+        "--sizes", type=lambda s: [int(n) for n in s.split(",") if n], default=[1000],
+        help="numbers of molecules of the SMILES scale-ups, e.g. 1000,10000,100000")
+    pipeline.add_argument(
+        "--max-3D", type=int, default=1000, help="largest scale-up also prepared with gen3D")
+    pipeline.add_argument(
+        "--max-calc", type=int, default=None,
+        help="largest file to calculate and export; all files by default")
+    pipeline.add_argument(
+        "--repeat", type=int, default=1, help="runs of each case; the median time is recorded")
+    pipeline.add_argument("-w", "--workers", type=int, default=1, help="number of workers")
+    pipeline.add_argument(
+        "--timeout", type=float, default=3600, help="seconds to wait for each step")
+    pipeline.add_argument(
+        "--examples", required=True,
+        help="directory of example.smi and example.sdf, e.g. help/examples of a checkout")
+    pipeline.add_argument(
+        "server_args", nargs=argparse.REMAINDER, help="further server options, after --")
+    pipeline.set_defaults(run=bench_pipeline)
+
+    compare = subparsers.add_parser(
+        "compare", help="compare two pipeline results, failing on regressions")
+    compare.add_argument("old", help="baseline result file")
+    compare.add_argument("new", help="new result file")
+    compare.add_argument(
+        "--threshold", type=float, default=0.1, help="relative slowdown counted as regression")
+    compare.add_argument(
+        "--min-seconds", type=float, default=0.5,
+        help="ignore stages faster than this, which are dominated by noise")
+    compare.set_defaults(run=bench_compare)
+
+    args = parser.parse_args(args)
+    if not hasattr(args, "run"):
+        parser.print_help()
+        sys.exit(1)
+
+    args.run(args)
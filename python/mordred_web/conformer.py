@@ -0,0 +1,126 @@
+import time
+
+from rdkit import Chem
+
+from .db import transaction
+
+
+def conformer_key(mol, params):
+    """Cache key of a 3D conformer: canonical isomeric SMILES and embedding parameters."""
+    return "{} {}".format(Chem.MolToSmiles(mol, isomericSmiles=True), params)
+
+
+def apply_conformer(mol, cached):
+    """Copy the coordinates of a cached conformer onto mol.
+
+    cached is a hydrogen-added molecule of the same structure, possibly in
+    another atom order. Returns None when the structures do not match.
+    """
+    mol = Chem.AddHs(mol)
+    if mol.GetNumAtoms() != cached.GetNumAtoms():
+        return None
+
+    match = mol.GetSubstructMatch(cached, useChirality=True)
+    if len(match) != mol.GetNumAtoms():
+        return None
+
+    src = cached.GetConformer()
+    conf = Chem.Conformer(mol.GetNumAtoms())
+    conf.Set3D(True)
+    for i, j in enumerate(match):
+        conf.SetAtomPosition(j, src.GetAtomPosition(i))
+
+    mol.RemoveAllConformers()
+    mol.AddConformer(conf, assignId=True)
+    return mol
+
+
+class ConformerCache(object):
+    """Persistent, size-bounded cache of optimized conformers.
+
+    Entries are evicted in least-recently-used order.
+    """
+
+    LOOKUP_SIZE = 500
+
+    def __init__(self, conn, max_size):
+        self.conn = conn
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        with transaction(conn) as cur:
+            cur.execute("SELECT count(*) FROM conformer")
+            self.size, = cur.fetchone()
+
+        self.evict()
+
+    def get_many(self, keys):
+        """Return {key: (forcefield, mol)} of cached keys."""
+        keys = list(keys)
+        found = {}
+        now = time.time()
+
+        with transaction(self.conn) as cur:
+            for i in range(0, len(keys), self.LOOKUP_SIZE):
+                chunk = keys[i:i + self.LOOKUP_SIZE]
+                cur.execute("""
+                SELECT key, forcefield, mol
+                FROM conformer
+                WHERE key IN ({})
+                """.format(",".join("?" * len(chunk))), chunk)
+
+                for key, forcefield, mol in cur.fetchall():
+                    found[key] = forcefield, mol
+
+                cur.executemany(
+                    "UPDATE conformer SET used_at = ? WHERE key = ?",
+                    [(now, key) for key in chunk if key in found], )
+
+        return found
+
+    def put(self, key, forcefield, mol):
+        with transaction(self.conn) as cur:
+            cur.execute("SELECT 1 FROM conformer WHERE key = ?", (key, ))
+            exists = cur.fetchone() is not None
+
+            cur.execute("""
+            INSERT OR REPLACE INTO conformer (key, forcefield, mol, used_at)
+            VALUES (?, ?, ?, ?)
+            """, (key, forcefield, mol, time.time()))
+
+        if not exists:
+            self.size += 1
+
+        self.evict()
+
+    def evict(self):
+        n = self.size - self.max_size
+        if n <= 0:
+            return
+
+        with transaction(self.conn) as cur:
+            cur.execute("""
+            DELETE FROM conformer
+            WHERE key IN (SELECT key FROM conformer ORDER BY used_at LIMIT ?)
+            """, (n, ))
+            self.size -= cur.rowcount
+            self.evictions += cur.rowcount
+
+    def record(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "evictions": self.evictions,
+            "hit_rate": None if total == 0 else self.hits / total,
+            "hits": self.hits,
+            "max_size": self.max_size,
+            "misses": self.misses,
+            "size": self.size,
+        }
@@ -1,11 +1,23 @@
+import os
+import time
 import uuid
+import zlib
 import sqlite3
 from enum import Enum
+from functools import partial
 from contextlib import closing, contextmanager
+from urllib.request import pathname2url
 
 import base58
 from rdkit import Chem
 
+from .metrics import SQLITE_COMMIT_SECONDS
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 def issue_text_id():
     return base58.b58encode(uuid.uuid4().bytes).decode()
@@ -20,7 +32,9 @@ def transaction(conn):
         conn.rollback()
         raise e
     else:
+        start = time.time()
         conn.commit()
+        SQLITE_COMMIT_SECONDS.observe(time.time() - start)
 
 
 class Phase(Enum):
@@ -69,6 +83,9 @@ schema = [
     )
     """,
     """
+    CREATE INDEX IF NOT EXISTS file_error__file_id ON file_error(file_id)
+    """,
+    """
     CREATE TABLE IF NOT EXISTS calc (
         id          INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
         file_id     INTEGER NOT NULL REFERENCES file(id) ON DELETE CASCADE ON UPDATE CASCADE,
@@ -82,6 +99,9 @@ schema = [
     CREATE INDEX IF NOT EXISTS calc__text_id ON calc(text_id)
     """,
     """
+    CREATE INDEX IF NOT EXISTS calc__file_id ON calc(file_id)
+    """,
+    """
     CREATE TABLE IF NOT EXISTS descriptor (
         id      INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
         calc_id INTEGER NOT NULL REFERENCES calc(id) ON DELETE CASCADE ON UPDATE CASCADE,
@@ -106,6 +126,23 @@ schema = [
     )
     """,  # noqa: E501
     """
+    CREATE INDEX IF NOT EXISTS result__molecule_id ON result(molecule_id)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS result__descriptor_id ON result(descriptor_id)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS conformer (
+        key        TEXT NOT NULL PRIMARY KEY,
+        forcefield TEXT NOT NULL,
+        mol        MOL  NOT NULL,
+        used_at    REAL NOT NULL
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS conformer__used_at ON conformer(used_at)
+    """,
+    """
     CREATE TABLE IF NOT EXISTS calc_error (
         id          INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
         calc_id     INTEGER NOT NULL REFERENCES calc(id) ON DELETE CASCADE ON UPDATE CASCADE,
@@ -113,32 +150,193 @@ schema = [
         error       TEXT NOT NULL
     )
     """,
+    """
+    CREATE INDEX IF NOT EXISTS calc_error__calc_id ON calc_error(calc_id)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS calc_error__molecule_id ON calc_error(molecule_id)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS profile (
+        id          INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+        file_id     INTEGER NOT NULL REFERENCES file(id) ON DELETE CASCADE ON UPDATE CASCADE,
+        calc_id     INTEGER REFERENCES calc(id) ON DELETE CASCADE ON UPDATE CASCADE,
+        molecule_id INTEGER REFERENCES molecule(id) ON DELETE CASCADE ON UPDATE CASCADE,
+        phase       TEXT NOT NULL,
+        wall        REAL NOT NULL,
+        queue_wait  REAL NOT NULL,
+        ipc         REAL NOT NULL
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS profile__calc_id ON profile(calc_id)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS profile__file_id ON profile(file_id)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS profile__molecule_id ON profile(molecule_id)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS profile_module (
+        profile_id INTEGER NOT NULL REFERENCES profile(id) ON DELETE CASCADE ON UPDATE CASCADE,
+        module     TEXT NOT NULL,
+        wall       REAL NOT NULL
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS profile_module__profile_id ON profile_module(profile_id)
+    """,
+]
+
+
+# columns added after the initial schema, applied in order by PRAGMA user_version
+migrations = [
+    """
+    ALTER TABLE file ADD COLUMN embed TEXT
+    """,
+    """
+    ALTER TABLE file ADD COLUMN profile INTEGER NOT NULL DEFAULT 0
+    """,
+    """
+    ALTER TABLE calc ADD COLUMN profile INTEGER NOT NULL DEFAULT 0
+    """,
+    """
+    ALTER TABLE file ADD COLUMN parse_started_at REAL
+    """,
+    """
+    ALTER TABLE file ADD COLUMN parse_finished_at REAL
+    """,
+    """
+    ALTER TABLE file ADD COLUMN prepare_started_at REAL
+    """,
+    """
+    ALTER TABLE file ADD COLUMN prepare_finished_at REAL
+    """,
+    """
+    ALTER TABLE calc ADD COLUMN started_at REAL
+    """,
+    """
+    ALTER TABLE calc ADD COLUMN finished_at REAL
+    """,
+    # indexes of foreign keys, which ON DELETE CASCADE looks rows up by
+    """
+    CREATE INDEX IF NOT EXISTS calc__file_id ON calc(file_id)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS file_error__file_id ON file_error(file_id)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS result__molecule_id ON result(molecule_id)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS result__descriptor_id ON result(descriptor_id)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS calc_error__calc_id ON calc_error(calc_id)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS calc_error__molecule_id ON calc_error(molecule_id)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS profile__molecule_id ON profile(molecule_id)
+    """,
+    # descriptors a profiled calc job ran, fewer than its calc has for reused
+    # molecules and parts of split ones
+    """
+    ALTER TABLE profile ADD COLUMN descriptors INTEGER
+    """,
 ]
 
 
-def adapt_mol(m):
-    return m.ToBinary()
+def migrate(cur):
+    cur.execute("PRAGMA user_version")
+    version, = cur.fetchone()
+    for m in migrations[version:]:
+        cur.execute(m)
+
+    cur.execute("PRAGMA user_version = {:d}".format(len(migrations)))
+
+
+# the first byte of a mol blob tells its codec; raw RDKit pickles start with
+# the little-endian magic number 0xDEADBEEF
+MOL_CODECS = {
+    "raw": b"\xef",
+    "zlib": b"\x01",
+    "zstd": b"\x02",
+}
+
+
+def encode_mol(b, codec="raw"):
+    if codec == "zlib":
+        return MOL_CODECS["zlib"] + zlib.compress(b, 6)
+    elif codec == "zstd":
+        return MOL_CODECS["zstd"] + zstandard.ZstdCompressor(level=3).compress(b)
+
+    return b
+
+
+def decode_mol(b):
+    b = bytes(b)
+    tag = b[:1]
+    if tag == MOL_CODECS["zlib"]:
+        return zlib.decompress(b[1:])
+    elif tag == MOL_CODECS["zstd"]:
+        if zstandard is None:
+            raise RuntimeError("zstd compressed molecules require zstandard")
+
+        return zstandard.ZstdDecompressor().decompress(b[1:])
+
+    return b
+
+
+def adapt_mol(m, codec="raw"):
+    return encode_mol(m.ToBinary(), codec)
 
 
 def convert_mol(b):
-    return Chem.Mol(b)
+    return Chem.Mol(decode_mol(b))
 
 
 @contextmanager
-def connect(db):
+def connect(db, readonly=False, mol_codec="raw"):
+    """Open the database, creating or migrating its schema.
+
+    A readonly connection expects an up-to-date schema. Molecules are written
+    with mol_codec; blobs of any codec are read.
+    """
+    if mol_codec == "zstd" and zstandard is None:
+        raise RuntimeError("zstd codec requires zstandard")
+
     sqlite_args = {
         "detect_types": sqlite3.PARSE_DECLTYPES,
         "isolation_level": "DEFERRED",
     }
 
-    sqlite3.register_adapter(Chem.Mol, adapt_mol)
+    sqlite3.register_adapter(Chem.Mol, partial(adapt_mol, codec=mol_codec))
     sqlite3.register_converter("MOL", convert_mol)
 
+    if readonly:
+        db = "file:{}?mode=ro".format(pathname2url(os.path.abspath(db)))
+        sqlite_args["uri"] = True
+
     with sqlite3.connect(db, **sqlite_args) as conn:
         conn.text_factory = str
         conn.execute("PRAGMA foreign_keys = ON")
-        with transaction(conn) as cur:
-            for s in schema:
-                cur.execute(s)
+        if not readonly:
+            # takes effect on new databases only
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            with transaction(conn) as cur:
+                for s in schema:
+                    cur.execute(s)
+
+                migrate(cur)
 
         yield conn
+
+
+def database_file(conn):
+    """Return the file of the main database of conn, to open more connections to."""
+    for _, name, path in conn.execute("PRAGMA database_list"):
+        if name == "main":
+            return path
@@ -44,7 +44,7 @@ class ExitableBoundedSemaphore(object):
 
     def acquire(self):
         while True:
-            if self._sem.acquire():
+            if self._sem.acquire(timeout=self.poll):
                 return
 
             elif self._exit.is_set():
@@ -0,0 +1,355 @@
+import os
+import gzip
+import zipfile
+from io import BytesIO
+
+import numpy as np
+from tornado import gen
+
+from .db import transaction
+from .lazy import lazy_import
+
+openpyxl = lazy_import("openpyxl")
+pyarrow = lazy_import("pyarrow")
+
+BATCH_SIZE = 256
+
+
+class ChunkBuffer(object):
+    """Write-only, non-seekable sink that is drained after every batch."""
+
+    def __init__(self):
+        self._chunks = []
+        self._pos = 0
+        self.closed = False
+
+    def write(self, b):
+        b = bytes(b)
+        self._chunks.append(b)
+        self._pos += len(b)
+        return len(b)
+
+    def tell(self):
+        return self._pos
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        b = b"".join(self._chunks)
+        self._chunks = []
+        return b
+
+
+def iter_batches(conn, calc_id, molecules, desc_ids, size=BATCH_SIZE):
+    """Yield (names, values, mask) of descriptor values by molecule batch.
+
+    values is a float64 array of shape (molecules, descriptors), and mask is
+    True where the value is missing.
+    """
+    column = {d: i for i, d in enumerate(desc_ids)}
+
+    for start in range(0, len(molecules), size):
+        batch = molecules[start:start + size]
+        row = {mol_id: i for i, (mol_id, _) in enumerate(batch)}
+
+        with transaction(conn) as cur:
+            cur.execute("""
+                SELECT molecule_id, descriptor_id, value
+                FROM result
+                WHERE calc_id = ? AND value IS NOT NULL AND molecule_id IN ({})
+            """.format(",".join("?" * len(batch))), [calc_id] + list(row))
+            results = cur.fetchall()
+
+        values = np.full((len(batch), len(desc_ids)), np.nan)
+        mask = np.ones(values.shape, dtype=bool)
+        if results:
+            r = [row[m] for m, _, _ in results]
+            c = [column[d] for _, d, _ in results]
+            values[r, c] = [v for _, _, v in results]
+            mask[r, c] = False
+
+        yield [name for _, name in batch], values, mask
+
+
+def _write_npy(z, name, array):
+    with z.open(name, "w", force_zip64=True) as f:
+        np.lib.format.write_array(f, array, allow_pickle=False)
+
+
+def npz_chunks(descriptors, total, batches):
+    """Stream a .npz archive with name, descriptor, value and mask arrays."""
+    sink = ChunkBuffer()
+    names, masks = [], []
+
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_STORED, allowZip64=True) as z:
+        with z.open("value.npy", "w", force_zip64=True) as f:
+            np.lib.format.write_array_header_1_0(f, {
+                "descr": np.lib.format.dtype_to_descr(np.dtype(np.float64)),
+                "fortran_order": False,
+                "shape": (total, len(descriptors)),
+            })
+
+            for batch_names, values, mask in batches:
+                f.write(values.tobytes())
+                names.extend(batch_names)
+                masks.append(mask)
+                yield sink.drain()
+
+        if masks:
+            mask = np.concatenate(masks)
+        else:
+            mask = np.zeros((0, len(descriptors)), dtype=bool)
+
+        _write_npy(z, "mask.npy", mask)
+        _write_npy(z, "name.npy", np.array(names, dtype=str))
+        _write_npy(z, "descriptor.npy", np.array(descriptors, dtype=str))
+
+    yield sink.drain()
+
+
+def _arrow_schema(descriptors):
+    fields = [pyarrow.field("name", pyarrow.string(), nullable=False)]
+    fields += [pyarrow.field(d, pyarrow.float64()) for d in descriptors]
+    return pyarrow.schema(fields)
+
+
+def _record_batch(schema, names, values, mask):
+    columns = [pyarrow.array(names, type=pyarrow.string())]
+    columns += [
+        pyarrow.array(values[:, i], type=pyarrow.float64(), mask=mask[:, i])
+        for i in range(values.shape[1])
+    ]
+    return pyarrow.RecordBatch.from_arrays(columns, schema=schema)
+
+
+def parquet_chunks(descriptors, total, batches):
+    """Stream a parquet file, one row group per batch."""
+    schema = _arrow_schema(descriptors)
+    sink = ChunkBuffer()
+
+    with pyarrow.parquet.ParquetWriter(sink, schema) as writer:
+        for names, values, mask in batches:
+            writer.write_batch(_record_batch(schema, names, values, mask))
+            yield sink.drain()
+
+    yield sink.drain()
+
+
+def arrow_chunks(descriptors, total, batches):
+    """Stream an Arrow IPC file, one record batch per batch."""
+    schema = _arrow_schema(descriptors)
+    sink = ChunkBuffer()
+
+    with pyarrow.ipc.new_file(sink, schema) as writer:
+        for names, values, mask in batches:
+            writer.write_batch(_record_batch(schema, names, values, mask))
+            yield sink.drain()
+
+    yield sink.drain()
+
+
+def _csv_value(v):
+    """Format v as CalcExport.csv would after a round trip through the result table.
+
+    The NUMBER column of the table stores integral floats as INTEGER, which
+    are read back as int.
+    """
+    if v.is_integer() and -2 ** 63 <= v < 2 ** 63:
+        return str(int(v))
+
+    return str(v)
+
+
+def csv_chunks(descriptors, total, batches):
+    """Stream CSV, leaving missing values empty."""
+    yield "name,{}\n".format(",".join(descriptors)).encode("UTF-8")
+
+    for names, values, mask in batches:
+        lines = [
+            "{},{}\n".format(
+                name, ",".join("" if m else _csv_value(v) for v, m in zip(row, missing)))
+            for name, row, missing in zip(names, values.tolist(), mask.tolist())
+        ]
+        yield "".join(lines).encode("UTF-8")
+
+
+# ext: (content type, stored gzip-compressed)
+FORMATS = {
+    "arrow": ("application/vnd.apache.arrow.file", False),
+    "csv": ("text/csv", True),
+    "npz": ("application/octet-stream", False),
+    "parquet": ("application/vnd.apache.parquet", False),
+    "txt": ("text/plain", True),
+    "xlsx": ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", False),
+}
+
+ARROW_EXTS = {"arrow", "parquet"}
+
+
+class CalcExport(object):
+    """Generate calc result files as a sequence of byte chunks."""
+
+    def __init__(self, conn, calc_id, file_id):
+        self.conn = conn
+        self.calc_id = calc_id
+
+        with transaction(conn) as cur:
+            cur.execute(
+                "SELECT id, name FROM molecule WHERE file_id = ? ORDER BY nth",
+                (file_id, ), )
+            self.molecules = cur.fetchall()
+
+            cur.execute(
+                "SELECT id, name FROM descriptor WHERE calc_id = ? ORDER BY id",
+                (calc_id, ), )
+            descs = cur.fetchall()
+
+        self.desc_ids = [i for i, _ in descs]
+        self.descriptors = [d for _, d in descs]
+
+    def chunks(self, ext):
+        if ext == "csv":
+            return self.csv()
+        elif ext == "xlsx":
+            return self.xlsx()
+        elif ext == "txt":
+            return self.txt()
+
+        writer = {
+            "arrow": arrow_chunks,
+            "npz": npz_chunks,
+            "parquet": parquet_chunks,
+        }[ext]
+        batches = iter_batches(self.conn, self.calc_id, self.molecules, self.desc_ids)
+        return writer(self.descriptors, len(self.molecules), batches)
+
+    def _molecule_batches(self):
+        for start in range(0, len(self.molecules), BATCH_SIZE):
+            yield self.molecules[start:start + BATCH_SIZE]
+
+    def _get_value_by_mol_id(self, cur, mol_id):
+        """Return the values of a molecule by descriptor, None where missing."""
+        cur.execute("""
+            SELECT descriptor_id, value
+            FROM result
+            WHERE calc_id = ? AND molecule_id = ?
+            """, (self.calc_id, mol_id))
+        values = dict(cur.fetchall())
+        return [values.get(d) for d in self.desc_ids]
+
+    def txt(self):
+        for batch in self._molecule_batches():
+            lines = []
+            with transaction(self.conn) as cur:
+                for mol_id, name in batch:
+                    cur.execute("""
+                        SELECT error
+                        FROM calc_error
+                        WHERE calc_id = ? AND molecule_id = ?
+                        ORDER BY id
+                    """, (self.calc_id, mol_id))
+
+                    for e, in cur.fetchall():
+                        lines.append("{}: {}\n".format(name, e))
+
+                    cur.execute("""
+                        SELECT descriptor.name, result.error
+                        FROM result JOIN descriptor ON result.descriptor_id = descriptor.id
+                        WHERE result.error IS NOT NULL AND result.calc_id = ? AND result.molecule_id = ?
+                        ORDER BY descriptor_id
+                    """, (self.calc_id, mol_id))  # noqa: E501
+
+                    for n, e in cur.fetchall():
+                        lines.append("{}:{}: {}\n".format(name, n, e))
+
+            yield "".join(lines).encode("UTF-8")
+
+    def csv(self):
+        yield "name,{}\n".format(",".join(self.descriptors)).encode("UTF-8")
+
+        for batch in self._molecule_batches():
+            lines = []
+            with transaction(self.conn) as cur:
+                for mol_id, name in batch:
+                    result = self._get_value_by_mol_id(cur, mol_id)
+                    lines.append("{},{}\n".format(
+                        name, ",".join(("" if v is None else str(v)) for v in result)))
+
+            yield "".join(lines).encode("UTF-8")
+
+    def xlsx(self):
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet()
+        ws.append(["name"] + self.descriptors)
+
+        for batch in self._molecule_batches():
+            with transaction(self.conn) as cur:
+                for mol_id, name in batch:
+                    ws.append([name] + self._get_value_by_mol_id(cur, mol_id))
+
+            yield b""
+
+        bio = BytesIO()
+        wb.save(bio)
+        yield bio.getvalue()
+
+
+class ExportCache(object):
+    """Export files of finished calcs, materialized on disk on first use."""
+
+    def __init__(self, root):
+        self.root = root
+        self._pending = {}
+
+    def relpath(self, text_id, ext):
+        name = "{}.{}".format(text_id, ext)
+        if FORMATS[ext][1]:
+            name += ".gz"
+
+        return os.path.join("calc", name)
+
+    def remove(self, text_id):
+        for ext in FORMATS:
+            try:
+                os.remove(os.path.join(self.root, self.relpath(text_id, ext)))
+            except OSError:
+                pass
+
+    @gen.coroutine
+    def get(self, text_id, ext, export):
+        relpath = self.relpath(text_id, ext)
+        path = os.path.join(self.root, relpath)
+        if os.path.exists(path):
+            raise gen.Return(relpath)
+
+        key = text_id, ext
+        fut = self._pending.get(key)
+        if fut is None:
+            fut = self._pending[key] = self._write(path, export.chunks(ext), FORMATS[ext][1])
+            fut.add_done_callback(lambda _: self._pending.pop(key, None))
+
+        yield fut
+        raise gen.Return(relpath)
+
+    @gen.coroutine
+    def _write(self, path, chunks, compress):
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            with (gzip.open(tmp, "wb") if compress else open(tmp, "wb")) as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield gen.moment
+
+            os.rename(tmp, path)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
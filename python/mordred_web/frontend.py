@@ -0,0 +1,127 @@
+import os
+import sys
+import errno
+import signal
+import socket
+
+from tornado import gen, web
+from loky import ProcessPoolExecutor
+from tornado.netutil import Resolver
+from tornado.httpclient import HTTPRequest
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
+
+# hop-by-hop headers, not forwarded by the proxy
+HOP_HEADERS = {"Connection", "Content-Length", "Keep-Alive", "Transfer-Encoding", "Host"}
+
+
+class UnixResolver(Resolver):
+    """Resolve every host to a unix socket."""
+
+    def initialize(self, path):
+        self.path = path
+
+    @gen.coroutine
+    def resolve(self, host, port, family=socket.AF_UNSPEC):
+        raise gen.Return([(socket.AF_UNIX, self.path)])
+
+
+class SchedulerProxy(object):
+    """Forward requests of a front end to the scheduler process."""
+
+    def __init__(self, path, timeout=600):
+        self.timeout = timeout
+        self.client = SimpleAsyncHTTPClient(
+            force_instance=True, resolver=UnixResolver(path=path))
+
+    @gen.coroutine
+    def forward(self, handler):
+        req = handler.request
+        headers = {k: v for k, v in req.headers.get_all() if k not in HOP_HEADERS}
+        headers["X-Forwarded-For"] = req.remote_ip
+
+        response = yield self.client.fetch(HTTPRequest(
+            "http://scheduler" + req.uri,
+            method=req.method,
+            headers=headers,
+            body=req.body if req.method in {"POST", "PUT", "PATCH"} else None,
+            allow_nonstandard_methods=True,
+            decompress_response=False,
+            follow_redirects=False,
+            request_timeout=self.timeout, ), raise_error=False)
+
+        if response.code == 599:
+            raise web.HTTPError(502, reason="scheduler unavailable")
+
+        handler.set_status(response.code, response.reason)
+        handler.clear_header("Content-Type")
+        for k, v in response.headers.get_all():
+            if k not in HOP_HEADERS and k not in {"Date", "Server"}:
+                handler.add_header(k, v)
+
+        if response.body:
+            handler.write(response.body)
+
+        handler.finish()
+
+
+class RenderPool(object):
+    """Worker pool of a front end, for jobs outside of the task queue."""
+
+    def __init__(self, workers):
+        self._pool = ProcessPoolExecutor(workers)
+
+    def submit(self, job):
+        return self._pool.submit(job)
+
+    def put(self, task):
+        raise RuntimeError("tasks are run by the scheduler process")
+
+    def check_workers(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self._pool.shutdown()
+
+
+def fork_processes(n):
+    """Fork n children and return the index of the child in each of them.
+
+    The parent forwards SIGTERM to the children, waits for them, and returns
+    None. The front ends are stopped when the scheduler (child 0) exits.
+    """
+    children = {}
+    for i in range(n):
+        pid = os.fork()
+        if pid == 0:
+            return i
+
+        children[pid] = i
+
+    def terminate(sig, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, terminate)
+    # SIGINT from the terminal reaches the children directly
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+
+        i = children.pop(pid, None)
+        if i == 0:
+            terminate(signal.SIGTERM, None)
+        elif i is not None and status != 0:
+            print("front end {} exited with status {}".format(i, status),  # noqa: T003
+                  file=sys.stderr)
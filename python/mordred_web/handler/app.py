@@ -1,8 +1,39 @@
 from .common import RequestHandler
+from ..metrics import REGISTRY, CONTENT_TYPE
 
 
 class AppInfoHandler(RequestHandler):
+    PROXY_METHODS = {"GET"}
+
     def get(self):
+        conformer_cache = self.application.conformer_cache
+        retention = self.application.retention
+
         self.write({
+            "conformer_cache": None if conformer_cache is None else conformer_cache.stats(),
+            "decompressed_size_limit": self.application.decompressed_size_limit,
             "file_size_limit": self.application.file_size_limit,
+            "ready": self.application.queue.ready,
+            "retention": None if retention is None else retention.stats(),
         })
+
+
+class ReadyHandler(RequestHandler):
+    """Readiness probe: 200 once the workers are warm, 503 before."""
+
+    PROXY_METHODS = {"GET"}
+
+    def get(self):
+        if not self.application.queue.ready:
+            self.set_status(503)
+
+        self.write({"ready": self.application.queue.ready})
+
+
+class MetricsHandler(RequestHandler):
+    PROXY_METHODS = {"GET"}
+
+    def get(self):
+        self.application.queue.check_workers()
+        self.set_header("content-type", CONTENT_TYPE)
+        self.write(REGISTRY.render())
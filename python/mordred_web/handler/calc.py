@@ -1,27 +1,44 @@
 import math
 import time
+import sqlite3
 from cgi import parse_header
-
-import openpyxl
-from mordred import Calculator, descriptors
-from tornado import gen, web
-from mordred.error import MissingValueBase
-
-from ..db import transaction, issue_text_id
-from .common import SSEHandler, RequestHandler
+from contextlib import closing
+
+from rdkit import Chem
+from tornado import gen, web, iostream
+
+from ..db import transaction, database_file, issue_text_id
+from ..shm import SharedBatch
+from ..lazy import lazy_import
+from ..metrics import MOLECULES
+from ..export import FORMATS, pyarrow, ARROW_EXTS, CalcExport
+from ..profiling import Profiled, record_profile, module_calculators
+from .common import Eta, SSEHandler, RequestHandler
 from ..task_queue import Task, SingleTask
 
+mordred = lazy_import("mordred")
+
 
 class PrepareTask(SingleTask):
     timeout = 60
+    phase = "setup"
 
-    def __init__(self, calc_id, total, file_id, disabled, conn, calc_timeout):
+    def __init__(self, calc_id, total, file_id, disabled, names, conn, calc_timeout,
+                 split_atoms=0, split_parts=1, transport="pickle", batch_size=1,
+                 cost_model=None, profile=False):
         self.calc_id = calc_id
         self.file_id = file_id
         self.disabled = disabled
+        self.names = names
         self.conn = conn
         self.total = total
         self.calc_timeout = calc_timeout
+        self.split_atoms = split_atoms
+        self.split_parts = split_parts
+        self.transport = transport
+        self.batch_size = batch_size
+        self.cost_model = cost_model
+        self.profile = profile
         self.error = False
 
     def on_job_error(self, job, e):
@@ -32,12 +49,17 @@ class PrepareTask(SingleTask):
                  "BUG: calculator prepare failed: {!r}".format(e)), )
         self.error = True
 
-    def on_job_end(self, job, calc):
-        self.calc = calc
+    def on_job_end(self, job, result):
+        self.calc, unknown = result
         self.desc_ids = []
 
         with transaction(self.conn) as cur:
-            for desc in calc.descriptors:
+            for name in unknown:
+                cur.execute(
+                    "INSERT INTO calc_error (calc_id, error) VALUES (?, ?)",
+                    (self.calc_id, "unknown descriptor: {}".format(name)), )
+
+            for desc in self.calc.descriptors:
                 cur.execute(
                     "INSERT INTO descriptor (calc_id, name) VALUES (?, ?)",
                     (self.calc_id, str(desc)), )
@@ -54,28 +76,92 @@ class PrepareTask(SingleTask):
             total=self.total,
             calc=self.calc,
             conn=self.conn,
-            timeout=self.calc_timeout, )
+            timeout=self.calc_timeout,
+            split_atoms=self.split_atoms,
+            split_parts=self.split_parts,
+            transport=self.transport,
+            batch_size=self.batch_size,
+            cost_model=self.cost_model,
+            profile=self.profile, )
         task.get_mols()
         return task
 
     def job(self):
-        return PrepareWorker(disabled=self.disabled)
+        return PrepareWorker(disabled=self.disabled, names=self.names)
 
 
 class PrepareWorker(object):
-    def __init__(self, disabled):
+    def __init__(self, disabled, names=None):
         self.disabled = disabled
+        self.names = names
 
     def __call__(self):
-        calc = Calculator(
+        descriptors = mordred.descriptors
+        calc = mordred.Calculator(
             getattr(descriptors, d) for d in descriptors.__all__
             if d not in self.disabled)
 
-        return calc
+        if not self.names:
+            return calc, []
+
+        selected = [d for d in calc.descriptors if str(d) in self.names]
+        unknown = sorted(self.names - {str(d) for d in selected})
+        return mordred.Calculator(selected), unknown
+
+
+def _dependencies(desc, seen):
+    for dep in (desc.dependencies() or {}).values():
+        if dep is None or dep in seen:
+            continue
+
+        seen.add(dep)
+        yield dep
+        for d in _dependencies(dep, seen):
+            yield d
+
+
+def partition(calc, desc_ids, parts):
+    """Split descriptors into at most parts (Calculator, desc_ids) groups.
+
+    Descriptors sharing intermediate results are kept in the same group
+    where possible; groups larger than an even share are cut, and recompute
+    their shared intermediates.
+    """
+    parent = {}
+
+    def find(x):
+        parent.setdefault(x, x)
+        while parent[x] is not x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for desc in calc.descriptors:
+        for dep in _dependencies(desc, set()):
+            parent[find(dep)] = find(desc)
+
+    components = {}
+    for desc, desc_id in zip(calc.descriptors, desc_ids):
+        components.setdefault(find(desc), []).append((desc, desc_id))
+
+    share = max(1, -(-len(desc_ids) // parts))
+    pieces = [c[i:i + share] for c in components.values() for i in range(0, len(c), share)]
+
+    # longest processing time first, by number of descriptors
+    bins = [[] for _ in range(parts)]
+    for piece in sorted(pieces, key=len, reverse=True):
+        min(bins, key=len).extend(piece)
+
+    return [(mordred.Calculator(d for d, _ in b), [i for _, i in b]) for b in bins if b]
 
 
 class CalcTask(Task):
-    def __init__(self, file_id, calc_id, desc_ids, calc, total, conn, timeout):
+    phase = "calc"
+    REUSE_BATCH = 32
+
+    def __init__(self, file_id, calc_id, desc_ids, calc, total, conn, timeout,
+                 split_atoms=0, split_parts=1, transport="pickle", batch_size=1,
+                 cost_model=None, profile=False):
         self.file_id = file_id
         self.calc_id = calc_id
         self.desc_ids = desc_ids
@@ -83,6 +169,22 @@ class CalcTask(Task):
         self.conn = conn
         self.total = total
         self.timeout = timeout
+        self.index = {desc_id: i for i, desc_id in enumerate(desc_ids)}
+        self.reused = set()
+        self.missing = calc, desc_ids
+        self.split_atoms = split_atoms
+        self.split_parts = split_parts
+        self.parts = {}
+        self.queued = []
+        self.splitting = {}
+        self.transport = transport
+        self.batch_size = batch_size
+        self.cost_model = cost_model
+        self.profile = profile
+        self.modules = {}
+        self.db_file = database_file(conn)
+        self.prepared = False
+        self.error = None
 
         Nd = len(desc_ids)
         self.max = [None] * Nd
@@ -99,22 +201,162 @@ class CalcTask(Task):
                 (self.file_id, ), )
             self.mols = cur.fetchall()
 
+    def find_reusable(self, cur):
+        """Find the finished calc of the same file sharing the most descriptors.
+
+        Returns its id and a map from its descriptor ids to ours.
+        """
+        ids = {str(d): i for d, i in zip(self.calc.descriptors, self.desc_ids)}
+
+        cur.execute(
+            "SELECT id FROM calc WHERE file_id = ? AND done = 1 AND id != ? ORDER BY id DESC",
+            (self.file_id, self.calc_id), )
+
+        best, best_map = None, {}
+        for calc_id, in cur.fetchall():
+            cur.execute(
+                "SELECT id, name FROM descriptor WHERE calc_id = ?", (calc_id, ))
+            desc_map = {i: ids[n] for i, n in cur.fetchall() if n in ids}
+            if len(desc_map) > len(best_map):
+                best, best_map = calc_id, desc_map
+
+        return best, best_map
+
+    def reuse(self):
+        """Copy results already computed by an earlier calc of the same file.
+
+        Molecules with copied results are only computed for the remaining
+        descriptors, or skipped when nothing remains. Runs on a worker thread
+        before the first job, with a connection of its own, and copies a few
+        molecules per transaction so that writes of the IOLoop don't wait long.
+        """
+        with closing(sqlite3.connect(self.db_file, isolation_level="DEFERRED")) as conn:
+            conn.execute("PRAGMA foreign_keys = ON")
+            with transaction(conn) as cur:
+                source, desc_map = self.find_reusable(cur)
+
+            if source is None:
+                return
+
+            mol_ids = [i for i, _ in self.mols]
+            for start in range(0, len(mol_ids), self.REUSE_BATCH):
+                batch = mol_ids[start:start + self.REUSE_BATCH]
+                with transaction(conn) as cur:
+                    cur.execute("""
+                        SELECT molecule_id, descriptor_id, value, error
+                        FROM result
+                        WHERE calc_id = ? AND molecule_id IN ({})
+                    """.format(",".join("?" * len(batch))), [source] + batch)
+                    rows = [(self.calc_id, mol_id, desc_map[desc_id], value, error)
+                            for mol_id, desc_id, value, error in cur.fetchall()
+                            if desc_id in desc_map]
+
+                    cur.executemany("""
+                        INSERT INTO result (calc_id, molecule_id, descriptor_id, value, error)
+                        VALUES (?, ?, ?, ?, ?)
+                        """, rows)
+
+                for _, mol_id, desc_id, value, error in rows:
+                    self.reused.add(mol_id)
+                    if error is None:
+                        self.accumulate(self.index[desc_id], value)
+
+            reused_ids = set(desc_map.values())
+            missing = [(d, i) for d, i in zip(self.calc.descriptors, self.desc_ids)
+                       if i not in reused_ids]
+            self.missing = mordred.Calculator(d for d, _ in missing), [i for _, i in missing]
+
+            if not missing:
+                with transaction(conn) as cur:
+                    cur.execute(
+                        "UPDATE calc SET current = current + ? WHERE id = ?",
+                        (len(self.reused), self.calc_id), )
+
+                self.mols = [(i, m) for i, m in self.mols if i not in self.reused]
+
+    def split(self):
+        """Partition the descriptors for molecules with at least split_atoms atoms."""
+        if self.split_atoms <= 0 or self.split_parts <= 1:
+            return
+
+        self.parts[False] = partition(self.calc, self.desc_ids, self.split_parts)
+        if self.reused:
+            calc, desc_ids = self.missing
+            self.parts[True] = partition(calc, desc_ids, self.split_parts)
+
+    def order(self):
+        """Start the costliest molecules first."""
+        if self.cost_model is not None:
+            self.mols = self.cost_model.order(self.mols, "calc", mol=lambda m: m[1])
+
+    def end_part(self, cur, job, error=None):
+        """Merge a part of a split molecule, finishing it with the last part."""
+        state = self.splitting[job.mol_id]
+        state["left"] -= 1
+        if error is not None:
+            state["failed"].append((job.desc_ids, error))
+
+        if state["left"] > 0:
+            return
+
+        del self.splitting[job.mol_id]
+        failed = state["failed"]
+        if len(failed) == job.parts:
+            cur.execute(
+                "INSERT INTO calc_error (calc_id, molecule_id, error) VALUES (?, ?, ?)",
+                (self.calc_id, job.mol_id, failed[0][1]), )
+            return
+
+        cur.executemany("""
+            INSERT INTO result (calc_id, molecule_id, descriptor_id, value, error)
+            VALUES (?, ?, ?, NULL, ?)
+            """, [(self.calc_id, job.mol_id, desc_id, error)
+                  for desc_ids, error in failed for desc_id in desc_ids])
+
+        cur.execute(
+            "UPDATE calc SET current = current + 1 WHERE id = ?",
+            (self.calc_id, ), )
+        MOLECULES.inc(phase="calc")
+
     def on_job_error(self, job, e):
         se = str(e)
         if len(se) == 0:
             se = repr(e)
 
+        if isinstance(job, CalcBatchWorker):
+            job.batch.unlink()
+            with transaction(self.conn) as cur:
+                cur.executemany(
+                    "INSERT INTO calc_error (calc_id, molecule_id, error) VALUES (?, ?, ?)",
+                    [(self.calc_id, mol_id, se) for mol_id in job.mol_ids], )
+            return
+
         with transaction(self.conn) as cur:
+            if job.parts > 1:
+                self.end_part(cur, job, se)
+                return
+
             cur.execute(
                 "INSERT INTO calc_error (calc_id, molecule_id, error) VALUES (?, ?, ?)",
                 (self.calc_id, job.mol_id, se), )
 
+    def on_task_start(self):
+        with transaction(self.conn) as cur:
+            cur.execute(
+                "UPDATE calc SET started_at = ? WHERE id = ?",
+                (time.time(), self.calc_id), )
+
     def on_task_end(self):
         std = ((None if k == 0 else math.sqrt(S / k))
                for S, k in zip(self.S, self.k))
         results = zip(self.desc_ids, self.min, self.max, self.mean, std)
 
         with transaction(self.conn) as cur:
+            if self.error is not None:
+                cur.execute(
+                    "INSERT INTO calc_error (calc_id, error) VALUES (?, ?)",
+                    (self.calc_id, self.error), )
+
             for desc_id, vmin, vmax, mean, std in results:
                 cur.execute(
                     """
@@ -123,15 +365,73 @@ class CalcTask(Task):
                     WHERE id = ?""",
                     (vmin, vmax, mean, std, desc_id), )
 
-            cur.execute("UPDATE calc SET done = 1 WHERE id = ?",
-                        (self.calc_id, ))
+            cur.execute("UPDATE calc SET done = 1, finished_at = ? WHERE id = ?",
+                        (time.time(), self.calc_id))
+
+    def accumulate(self, i, value):
+        if self.max[i] is None or self.max[i] < value:
+            self.max[i] = value
+
+        if self.min[i] is None or self.min[i] > value:
+            self.min[i] = value
+
+        self.mean[i] = (self.mean[i] or 0) + value / self.total
+
+        self.k[i] += 1
+
+        M = self.M[i]
+        self.M[i] += (value - M) / self.k[i]
+        self.S[i] += (value - M) * (value - self.M[i])
+
+    def end_batch(self, job, result):
+        messages, failed = result
+        try:
+            rows = [
+                (self.calc_id, job.mol_ids[row], job.desc_ids[col], value, error)
+                for row, col, value, error in job.batch.read(messages) if row not in failed]
+        finally:
+            job.batch.unlink()
+
+        with transaction(self.conn) as cur:
+            cur.executemany(
+                "INSERT INTO calc_error (calc_id, molecule_id, error) VALUES (?, ?, ?)",
+                [(self.calc_id, job.mol_ids[row], error) for row, error in sorted(failed.items())])
+
+            cur.executemany("""
+                INSERT INTO result (calc_id, molecule_id, descriptor_id, value, error)
+                VALUES (?, ?, ?, ?, ?)
+                """, rows)
+
+            for _, _, desc_id, value, error in rows:
+                if error is None:
+                    self.accumulate(self.index[desc_id], value)
+
+            done = len(job.mol_ids) - len(failed)
+            cur.execute(
+                "UPDATE calc SET current = current + ? WHERE id = ?",
+                (done, self.calc_id), )
+            MOLECULES.inc(done, phase="calc")
 
     def on_job_end(self, job, results):
+        if isinstance(job, CalcBatchWorker):
+            return self.end_batch(job, results)
+
+        profiled = None
+        if isinstance(results, Profiled):
+            profiled, results = results, results.value
 
         with transaction(self.conn) as cur:
-            for i, (desc_id, result) in enumerate(zip(self.desc_ids, results)):
+            if profiled is not None:
+                record_profile(
+                    cur, job, profiled, "calc",
+                    file_id=self.file_id,
+                    calc_id=self.calc_id,
+                    molecule_id=job.mol_id,
+                    descriptors=len(job.desc_ids), )
+
+            for desc_id, result in zip(job.desc_ids, results):
                 value, error = None, None
-                if isinstance(result, MissingValueBase):
+                if isinstance(result, mordred.error.MissingValueBase):
                     error = str(result.error)
                 else:
                     value = result
@@ -144,43 +444,151 @@ class CalcTask(Task):
                 if error:
                     continue
 
-                if self.max[i] is None or self.max[i] < value:
-                    self.max[i] = value
+                self.accumulate(self.index[desc_id], value)
 
-                if self.min[i] is None or self.min[i] > value:
-                    self.min[i] = value
-
-                self.mean[i] = (self.mean[i] or 0) + value / self.total
-
-                self.k[i] += 1
-
-                M = self.M[i]
-                self.M[i] += (value - M) / self.k[i]
-                self.S[i] += (value - M) * (value - self.M[i])
+            if job.parts > 1:
+                self.end_part(cur, job)
+                return
 
             cur.execute(
                 "UPDATE calc SET current = current + 1 WHERE id = ?",
                 (self.calc_id, ), )
+            MOLECULES.inc(phase="calc")
+
+    def prepare(self):
+        """Order molecules, reuse results and split descriptors, off the IOLoop."""
+        self.prepared = True
+        try:
+            self.order()
+            self.reuse()
+            self.split()
+        except Exception as e:
+            self.error = "BUG: preparing molecules failed: {!r}".format(e)
+            raise StopIteration
 
     def __next__(self):
+        if not self.prepared:
+            self.prepare()
+
+        if self.queued:
+            return self.queued.pop()
+
         if len(self.mols) == 0:
             raise StopIteration
         (mol_id, mol), self.mols = self.mols[0], self.mols[1:]
-        return CalcWorker(mol, mol_id, self.calc)
+        reused = mol_id in self.reused
+
+        parts = self.parts_of(mol, reused)
+        if parts is not None:
+            self.splitting[mol_id] = {"failed": [], "left": len(parts)}
+            self.queued = [
+                self.worker(mol, mol_id, calc, desc_ids, len(parts))
+                for calc, desc_ids in parts
+            ]
+            return self.queued.pop()
+
+        calc, desc_ids = self.missing if reused else (self.calc, self.desc_ids)
+
+        if self.transport == "shm" and not self.profile:
+            batch = [(mol_id, mol)]
+            for i, m in self.mols[:self.batch_size - 1]:
+                if (i in self.reused) != reused or self.parts_of(m, reused) is not None:
+                    break
+
+                batch.append((i, m))
+
+            self.mols = self.mols[len(batch) - 1:]
+            timeout = None if self.timeout is None else self.timeout * len(batch)
+            return CalcBatchWorker(
+                SharedBatch.create([m for _, m in batch], len(desc_ids)),
+                [i for i, _ in batch], calc, desc_ids, timeout)
+
+        return self.worker(mol, mol_id, calc, desc_ids)
+
+    def parts_of(self, mol, reused):
+        """Return the descriptor parts mol is split into, or None."""
+        parts = self.parts.get(reused)
+        if parts is not None and len(parts) > 1 and mol.GetNumAtoms() >= self.split_atoms:
+            return parts
+
+        return None
+
+    def worker(self, mol, mol_id, calc, desc_ids, parts=1):
+        modules = None
+        if self.profile:
+            modules = self.modules.get(id(calc))
+            if modules is None:
+                modules = self.modules[id(calc)] = module_calculators(calc)
+
+        return CalcWorker(mol, mol_id, calc, desc_ids, parts, modules)
 
 
 class CalcWorker(object):
-    def __init__(self, mol, mol_id, calc):
+    def __init__(self, mol, mol_id, calc, desc_ids, parts=1, modules=None):
         self.mol = mol
         self.mol_id = mol_id
         self.calc = calc
+        self.desc_ids = desc_ids
+        self.parts = parts
+        self.modules = modules
+        self.submitted_at = time.time()
 
     def __call__(self):
-        return self.calc(self.mol)
+        if self.modules is None:
+            return self.calc(self.mol)
+
+        started = time.time()
+        results = [None] * len(self.desc_ids)
+        timings = []
+        for name, calc, indices in self.modules:
+            t = time.time()
+            for i, v in zip(indices, calc(self.mol)):
+                results[i] = v
+
+            timings.append((name, time.time() - t))
+
+        return Profiled(results, started, time.time(), timings)
+
+
+class CalcBatchWorker(object):
+    """Calculate a batch of molecules in shared memory, writing the results there.
+
+    Returns the error messages and the errors of molecules failed as a whole.
+    """
+
+    def __init__(self, batch, mol_ids, calc, desc_ids, timeout):
+        self.batch = batch
+        self.mol_ids = mol_ids
+        self.calc = calc
+        self.desc_ids = desc_ids
+        self.timeout = timeout
+        self.submitted_at = time.time()
+
+    def __call__(self):
+        MissingValueBase = mordred.error.MissingValueBase
+        messages, failed = {}, {}
+        self.batch.attach()
+        try:
+            for row in range(len(self.batch)):
+                try:
+                    results = self.calc(Chem.Mol(self.batch.mol(row)))
+                except Exception as e:
+                    failed[row] = str(e) or repr(e)
+                    continue
+
+                self.batch.write(row, [
+                    (None, str(r.error)) if isinstance(r, MissingValueBase) else (r, None)
+                    for r in results], messages)
+        finally:
+            self.batch.close()
+
+        return sorted(messages, key=messages.get), failed
 
 
 class CalcIdHandler(SSEHandler):
     def post(self, file_text_id):
+        profile = self.get_flag("profile", False)
+
         with self.transaction() as cur:
             cur.execute(
                 "SELECT id, name, total FROM file WHERE text_id = ? LIMIT 1",
@@ -194,20 +602,28 @@ class CalcIdHandler(SSEHandler):
             calc_text_id = issue_text_id()
 
             cur.execute("""
-            INSERT INTO calc (file_id, text_id, created_at, current, done)
-            VALUES (?, ?, ?, 0, 0)""", (file_id, calc_text_id,
-                                        int(time.time())))
+            INSERT INTO calc (file_id, text_id, created_at, current, done, profile)
+            VALUES (?, ?, ?, 0, 0, ?)""", (file_id, calc_text_id,
+                                           int(time.time()), profile))
 
             calc_id = cur.lastrowid
 
         disabled = set(self.get_arguments("disabled"))
+        names = set(self.get_arguments("descriptor"))
         task = PrepareTask(
             calc_id=calc_id,
             file_id=file_id,
             total=total,
             disabled=disabled,
+            names=names,
             conn=self.db,
-            calc_timeout=self.application.calc_timeout, )
+            calc_timeout=self.application.calc_timeout,
+            split_atoms=self.application.split_atoms,
+            split_parts=self.application.split_parts,
+            transport=self.application.transport,
+            batch_size=self.application.batch_size,
+            cost_model=self.application.cost_model,
+            profile=profile, )
         self.put(task)
 
         self.json(id=calc_text_id)
@@ -235,9 +651,18 @@ class CalcIdHandler(SSEHandler):
         else:
             return self.get_json()
 
+    TIMESTAMPS = ("created_at", "started_at", "finished_at")
+
+    def get_timestamps(self, cur):
+        cur.execute(
+            "SELECT {} FROM calc WHERE id = ? LIMIT 1".format(", ".join(self.TIMESTAMPS)),
+            (self.calc_id, ), )
+        return dict(zip(self.TIMESTAMPS, cur.fetchone()))
+
     @gen.coroutine
     def get_sse(self):
         self.init_sse()
+        eta = Eta()
         while True:
             with self.transaction() as cur:
                 cur.execute(
@@ -245,12 +670,15 @@ class CalcIdHandler(SSEHandler):
                     (self.calc_id, ), )
 
                 done, current = cur.fetchone()
+                timestamps = self.get_timestamps(cur)
 
             yield self.publish(
                 total=self.total,
                 name=self.file_name,
                 done=bool(done),
-                current=current, )
+                current=current,
+                eta=eta.update(current, self.total, timestamps["started_at"]),
+                **timestamps)
 
             if done:
                 raise web.Finish
@@ -296,103 +724,152 @@ class CalcIdHandler(SSEHandler):
             } for name, vmax, vmin, mean, std in cur.fetchall()]
 
             file_name, file_text_id = result
+            timestamps = self.get_timestamps(cur)
 
             self.json(
                 file_name=file_name,
                 file_id=file_text_id,
                 errors=errors,
-                descriptors=descs, )
+                descriptors=descs,
+                **timestamps)
+
+
+class CalcIdProfileHandler(RequestHandler):
+    def get(self, calc_text_id):
+        with self.transaction() as cur:
+            cur.execute(
+                "SELECT id, file_id, profile FROM calc WHERE text_id = ? LIMIT 1",
+                (calc_text_id, ))
+            result = cur.fetchone()
+            if result is None:
+                self.fail(404, "no id")
 
+            calc_id, file_id, profile = result
+            if not profile:
+                self.fail(404, "calc is not profiled")
 
-class CalcIdExtHandler(RequestHandler):
-    EXTS = {"csv", "xlsx", "txt"}
+            cur.execute("""
+                SELECT phase, count(DISTINCT molecule_id), sum(wall), sum(queue_wait), sum(ipc)
+                FROM profile
+                WHERE calc_id = ? OR (calc_id IS NULL AND file_id = ?)
+                GROUP BY phase
+            """, (calc_id, file_id))
+
+            phases = {phase: {
+                "ipc": ipc,
+                "molecules": n,
+                "queue_wait": queue_wait,
+                "wall": wall,
+            } for phase, n, wall, queue_wait, ipc in cur.fetchall()}
 
-    def get(self, calc_text_id, ext):
+            cur.execute("""
+                SELECT module, count(*), sum(profile_module.wall), max(profile_module.wall)
+                FROM profile_module JOIN profile ON profile_module.profile_id = profile.id
+                WHERE profile.calc_id = ?
+                GROUP BY module
+                ORDER BY sum(profile_module.wall) DESC
+            """, (calc_id, ))
+
+            modules = [{
+                "count": n,
+                "max": vmax,
+                "mean": total / n,
+                "name": name,
+                "total": total,
+            } for name, n, total, vmax in cur.fetchall()]
+
+            cur.execute("""
+                SELECT molecule.nth, molecule.name, p.wall, p.queue_wait, p.ipc, prep.wall
+                FROM molecule
+                LEFT OUTER JOIN (
+                    SELECT molecule_id, sum(wall) AS wall, sum(queue_wait) AS queue_wait,
+                           sum(ipc) AS ipc
+                    FROM profile WHERE calc_id = ? GROUP BY molecule_id
+                ) AS p ON p.molecule_id = molecule.id
+                LEFT OUTER JOIN (
+                    SELECT molecule_id, wall FROM profile WHERE file_id = ? AND phase = 'prepare'
+                ) AS prep ON prep.molecule_id = molecule.id
+                WHERE molecule.file_id = ?
+                ORDER BY p.wall DESC, molecule.nth
+            """, (calc_id, file_id, file_id))
+
+            molecules = [{
+                "calc": wall,
+                "ipc": ipc,
+                "name": name,
+                "nth": nth,
+                "prepare": prepare,
+                "queue_wait": queue_wait,
+            } for nth, name, wall, queue_wait, ipc, prepare in cur.fetchall()]
+
+        self.json(
+            phases=phases,
+            modules=modules,
+            molecules=molecules, )
+
+
+class CalcIdExtHandler(web.StaticFileHandler, RequestHandler):
+    EXTS = set(FORMATS)
+
+    @gen.coroutine
+    def get(self, calc_text_id, ext, include_body=True):
         ext = ext.lower()
         if ext not in self.EXTS:
             self.fail(400, "unknown extension")
 
+        if ext in ARROW_EXTS and pyarrow is None:
+            self.fail(501, "{} export requires pyarrow".format(ext))
+
         with self.transaction() as cur:
             cur.execute(
-                "SELECT id, file_id FROM calc WHERE text_id = ? LIMIT 1",
+                "SELECT id, file_id, done FROM calc WHERE text_id = ? LIMIT 1",
                 (calc_text_id, ))
             result = cur.fetchone()
             if result is None:
                 self.fail(404, "no id")
 
-            self.calc_id, self.file_id = result
+            calc_id, file_id, done = result
 
-            cur.execute(
-                "SELECT id, name FROM molecule WHERE file_id = ? ORDER BY nth",
-                (self.file_id, ), )
-            self.molecules = cur.fetchall()
+        self.ext = ext
+        export = CalcExport(self.db, calc_id, file_id)
 
-            cur.execute(
-                "SELECT name FROM descriptor WHERE calc_id = ? ORDER BY id",
-                (self.calc_id, ), )
-            self.descriptors = [d for d, in cur.fetchall()]
+        gzipped = FORMATS[ext][1]
+        accept_gzip = "gzip" in self.request.headers.get("Accept-Encoding", "")
 
-            if ext == "csv":
-                return self.get_csv(cur)
-            elif ext == "xlsx":
-                return self.get_xlsx(cur)
-            elif ext == "txt":
-                return self.get_error_log(cur)
+        if not done or (gzipped and not accept_gzip):
+            yield self.stream(export)
+            return
 
-    def get_error_log(self, cur):
-        self.set_header("content-type", "text/plain")
+        path = yield self.application.export_cache.get(calc_text_id, ext, export)
+        yield super(CalcIdExtHandler, self).get(path, include_body=include_body)
 
-        for mol_id, name in self.molecules:
-            cur.execute("""
-                SELECT error
-                FROM calc_error
-                WHERE calc_id = ? AND molecule_id = ?
-                ORDER BY id
-            """, (self.calc_id, mol_id))
+    def head(self, calc_text_id, ext):
+        return self.get(calc_text_id, ext, include_body=False)
+
+    @gen.coroutine
+    def stream(self, export):
+        self.set_header("content-type", FORMATS[self.ext][0])
 
-            for e, in cur.fetchall():
-                self.write("{}: {}\n".format(name, e))
+        for chunk in export.chunks(self.ext):
+            if not chunk:
+                yield gen.moment
+                continue
 
-            cur.execute("""
-                SELECT descriptor.name, result.error
-                FROM result JOIN descriptor ON result.descriptor_id = descriptor.id
-                WHERE result.error IS NOT NULL AND result.calc_id = ? AND result.molecule_id = ?
-                ORDER BY descriptor_id
-            """, (self.calc_id, mol_id))
-
-            for n, e in cur.fetchall():
-                self.write('{}:{}: {}\n'.format(name, n, e))
-
-    def _get_value_by_mol_id(self, cur, mol_id):
-        cur.execute("""
-            SELECT value
-            FROM result
-            WHERE calc_id = ? AND molecule_id = ?
-            ORDER BY descriptor_id
-            """, (self.calc_id, mol_id))
-        return cur.fetchall()
-
-    def get_csv(self, cur):
-        self.set_header("content-type", "text/csv")
-        self.write("name,")
-        self.write(",".join(self.descriptors))
-        self.write("\n")
-
-        for mol_id, name in self.molecules:
-            self.write(name + ",")
-            result = self._get_value_by_mol_id(cur, mol_id)
-            self.write(",".join(("" if v is None else str(v)) for v, in result))
-            self.write("\n")
-
-    def get_xlsx(self, cur):
-        self.set_header(
-            "content-type",
-            "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
-        wb = openpyxl.Workbook()
-        ws = wb.active
-        ws.append(["name"] + self.descriptors)
-
-        for mol_id, name in self.molecules:
-            ws.append([name] + [v for v, in self._get_value_by_mol_id(cur, mol_id)])
-
-        self.write(openpyxl.writer.excel.save_virtual_workbook(wb))
+            self.write(chunk)
+            try:
+                yield self.flush()
+            except iostream.StreamClosedError:
+                return
+
+    def compute_etag(self):
+        if getattr(self, "absolute_path", None) is None:
+            return super(web.StaticFileHandler, self).compute_etag()
+
+        return super(CalcIdExtHandler, self).compute_etag()
+
+    def get_content_type(self):
+        return FORMATS[self.ext][0]
+
+    def set_extra_headers(self, path):
+        if FORMATS[self.ext][1]:
+            self.set_header("Content-Encoding", "gzip")
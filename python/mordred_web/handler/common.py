@@ -1,12 +1,23 @@
 import json
+import time
 from contextlib import contextmanager
 
 from tornado import gen, web, iostream
 
 from ..db import transaction
+from ..metrics import SSE_SUBSCRIBERS
 
 
 class RequestHandler(web.RequestHandler):
+    # methods forwarded to the scheduler when running as a front end
+    PROXY_METHODS = {"POST"}
+
+    @gen.coroutine
+    def prepare(self):
+        proxy = getattr(self.application, "proxy", None)
+        if proxy is not None and self.request.method in self.PROXY_METHODS:
+            yield proxy.forward(self)
+
     @contextmanager
     def transaction(self):
         with transaction(self.db) as cur:
@@ -37,10 +48,57 @@ class RequestHandler(web.RequestHandler):
         return self.write(kwargs)
 
 
+class Eta(object):
+    """Estimate the remaining time of a phase.
+
+    The throughput is an exponentially weighted moving average of the
+    molecules/s between progress updates, starting from the average since
+    the phase started.
+    """
+
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        self.rate = None
+        self.current = None
+        self.updated_at = None
+
+    def update(self, current, total, started_at, now=None):
+        if now is None:
+            now = time.time()
+
+        if started_at is None or total is None or current is None:
+            return None
+
+        if self.rate is None:
+            if current > 0 and now > started_at:
+                self.rate = current / (now - started_at)
+                self.current, self.updated_at = current, now
+
+        elif current != self.current:
+            rate = (current - self.current) / max(now - self.updated_at, 1e-6)
+            self.rate = self.alpha * rate + (1 - self.alpha) * self.rate
+            self.current, self.updated_at = current, now
+
+        if not self.rate:
+            return None
+
+        eta = (total - current) / self.rate - (now - self.updated_at)
+        return max(eta, 0.0)
+
+
 class SSEHandler(RequestHandler):
+    subscribed = False
+
     def init_sse(self):
         self.set_header("content-type", "text/event-stream")
         self.set_header("cache-control", "no-cache")
+        self.subscribed = True
+        SSE_SUBSCRIBERS.inc()
+
+    def on_finish(self):
+        if self.subscribed:
+            self.subscribed = False
+            SSE_SUBSCRIBERS.dec()
 
     @gen.coroutine
     def publish(self, **obj):
@@ -1,10 +1,82 @@
-from mordred import descriptors
+import os
+import json
+import hashlib
+from importlib import metadata
 
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from ..lazy import lazy_import
 from .common import RequestHandler
 
+mordred = lazy_import("mordred")
+
+
+class DescriptorInfoJob(object):
+    """Return descriptor metadata as (JSON, ETag), cached as a file at path.
+
+    Runs on a thread of the server, which owns path: the metadata never
+    depends on a worker, which may be a remote node without the cache.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self):
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                body = f.read()
+        else:
+            body = json.dumps(self.build(), sort_keys=True).encode("UTF-8")
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = "{}.{}.tmp".format(self.path, os.getpid())
+            with open(tmp, "wb") as f:
+                f.write(body)
+
+            os.replace(tmp, self.path)
+
+        return body, '"{}"'.format(hashlib.sha1(body).hexdigest())
+
+    def build(self):
+        descriptors = mordred.descriptors
+        modules = []
+        for name in descriptors.__all__:
+            descs = mordred.Calculator(getattr(descriptors, name)).descriptors
+            modules.append({
+                "count": len(descs),
+                "count_3D": sum(1 for d in descs if d.require_3D),
+                "name": name,
+            })
+
+        return {
+            "descriptors": descriptors.__all__,
+            "modules": modules,
+            "total": sum(m["count"] for m in modules),
+            "total_3D": sum(m["count_3D"] for m in modules),
+            "version": metadata.version("mordred"),
+        }
+
 
 class DescriptorHandler(RequestHandler):
+    @gen.coroutine
     def get(self):
-        self.write({
-            "descriptors": descriptors.__all__,
-        })
+        app = self.application
+        if app.descriptor_info is None:
+            path = os.path.join(
+                app.export_cache.root, "descriptors-{}.json".format(metadata.version("mordred")))
+            app.descriptor_info = IOLoop.current().run_in_executor(
+                None, DescriptorInfoJob(path))
+
+        try:
+            body, etag = yield app.descriptor_info
+        except Exception:
+            app.descriptor_info = None
+            raise
+
+        self.set_header("Etag", etag)
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.write(body)
@@ -1,26 +1,47 @@
+import io
 import os
 import re
+import bz2
+import gzip
+import json
+import lzma
 import time
-from io import BytesIO
+import zipfile
+from io import BytesIO, StringIO
 from cgi import parse_header
-from tempfile import NamedTemporaryFile
 
 from rdkit import Chem
-from tornado import gen, web
-from rdkit.Chem import Draw
-from rdkit.Chem.rdDistGeom import EmbedMolecule
-from rdkit.Chem.rdForceFieldHelpers import UFFOptimizeMolecule, MMFFOptimizeMolecule
+from tornado import gen, web, iostream
+from rdkit.Chem.rdDistGeom import ETKDGv3, EmbedMolecule, EmbedMultipleConfs
+from rdkit.Chem.rdForceFieldHelpers import (UFFOptimizeMolecule, MMFFOptimizeMolecule,
+                                            UFFOptimizeMoleculeConfs, MMFFHasAllMoleculeParams,
+                                            MMFFOptimizeMoleculeConfs)
 
 from ..db import Phase, transaction, issue_text_id
-from .common import SSEHandler, RequestHandler
+from ..lazy import lazy_import
+from ..metrics import MOLECULES
+from ..conformer import conformer_key, apply_conformer
+from ..profiling import Profiled, run_profiled, record_profile
+from .common import Eta, SSEHandler, RequestHandler
 from ..task_queue import Task, SingleTask
 
+Draw = lazy_import("rdkit.Chem.Draw")
+
 MEGA = 1024 * 1024
+
+# default grid image, pre-rendered when preparation finishes
+GRID_COUNT = 50
+GRID_COLS = 10
+GRID_SIZE = 200
+GRID_MAX = 100
+# files of a zip archive uploaded as separate files
+MAX_ARCHIVE_FILES = 100
 SMI_FIELDS = re.compile(br"^(\S+)\s+(.+)?")
 
 
-def read_smiles(bs):
-    for i, line in enumerate(BytesIO(bs), 1):
+def read_smiles(f):
+    """Read (mol, name) from a binary SMILES stream; mol is an error on failure."""
+    for i, line in enumerate(f, 1):
         fields = SMI_FIELDS.match(line)
         if fields is None:
             yield ValueError("parse failed on line {}".format(i)), None
@@ -39,64 +60,160 @@ def read_smiles(bs):
         yield mol, name.decode("UTF-8")
 
 
-def read_sdf(bs):
-    with NamedTemporaryFile() as tmp:
-        tmp.write(bs)
-        tmp.flush()
+def read_sdf(f):
+    """Read (mol, name) from a binary SDF stream; mol is an error on failure."""
+    for i, mol in enumerate(Chem.ForwardSDMolSupplier(f, removeHs=False), 1):
+        if mol is None:
+            yield ValueError(
+                "SDF parser failed on {}-th molecule".format(i)), None
+            continue
 
-        for i, mol in enumerate(
-                Chem.SDMolSupplier(tmp.name, removeHs=False), 1):
-            if mol is None:
-                yield ValueError(
-                    "SDF parser failed on {}-th molecule".format(i)), None
-                continue
+        if mol.HasProp("_Name"):
+            name = mol.GetProp("_Name")
+        else:
+            name = Chem.MolToSmiles(mol)
+
+        yield mol, name
+
+
+READERS = {
+    ".mol": read_sdf,
+    ".sd": read_sdf,
+    ".sdf": read_sdf,
+    ".smi": read_smiles,
+    ".smiles": read_smiles,
+}
+
+# streaming decompressors by extension, e.g. lib.sdf.gz
+DECOMPRESSORS = {
+    ".bz2": bz2.open,
+    ".gz": gzip.open,
+    ".xz": lzma.open,
+}
+
+
+def get_reader(name):
+    """Return (reader, decompressor) of a file name; either may be None."""
+    base, ext = os.path.splitext(name.lower())
+    decompress = DECOMPRESSORS.get(ext)
+    if decompress is not None:
+        ext = os.path.splitext(base)[1]
+
+    return READERS.get(ext), decompress
+
+
+def is_archive(name):
+    return name.lower().endswith(".zip")
+
+
+def archive_members(archive):
+    """Return names of the readable and the other files of a zip archive."""
+    members, skipped = [], []
+    for info in archive.infolist():
+        if info.is_dir():
+            continue
+
+        if get_reader(info.filename)[0] is None:
+            skipped.append(info.filename)
+        else:
+            members.append(info.filename)
+
+    return members, skipped
+
+
+class LimitedReader(io.RawIOBase):
+    """Binary stream of f ending once more than limit bytes are read.
 
-            if mol.HasProp("_Name"):
-                name = mol.GetProp("_Name")
-            else:
-                name = Chem.MolToSmiles(mol)
+    The end is signalled by EOF, as exceptions do not pass through the RDKit
+    readers; check() raises ValueError if the limit was exceeded.
+    """
 
-            yield mol, name
+    def __init__(self, f, limit):
+        self.f = f
+        self.limit = limit
+        self.count = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.count > self.limit:
+            return 0
+
+        n = self.f.readinto(b)
+        self.count += n
+        return 0 if self.count > self.limit else n
+
+    def check(self):
+        if self.count > self.limit:
+            raise ValueError(
+                "decompressed size too large (> {}MB)".format(self.limit // MEGA))
+
+
+def open_input(f, name, limit=None):
+    """Return the reader of name and a stream of f, decompressed by the extension of name."""
+    reader, decompress = get_reader(name)
+    if decompress is not None:
+        f = decompress(f)
+
+    if limit is not None:
+        f = io.BufferedReader(LimitedReader(f, limit))
+
+    return reader, f
 
 
 class ParseTask(SingleTask):
-    def __init__(self, text_id, filename, body, gen3D, desalt, conn, reader,
-                 parse_timeout, prepare_timeout, molecule_limit):
+    phase = "parse"
+
+    def __init__(self, text_id, filename, body, gen3D, desalt, embed, embed_threads, conn,
+                 image_cache, conformer_cache, parse_timeout, prepare_timeout, molecule_limit,
+                 size_limit, members=None, cost_model=None, profile=False):
 
         self.conn = conn
+        self.image_cache = image_cache
+        self.conformer_cache = conformer_cache
         self.text_id = text_id
         self.filename = filename
         self.body = body
         self.gen3D = gen3D
         self.desalt = desalt
-        self.reader = reader
+        self.embed = embed
+        self.embed_threads = embed_threads
+        self.members = members
         self.timeout = parse_timeout
         self.prepare_timeout = prepare_timeout
         self.molecule_limit = molecule_limit
+        self.size_limit = size_limit
+        self.cost_model = cost_model
+        self.profile = profile
 
     def insert_file(self):
-        is3D = self.reader != read_smiles or self.gen3D
+        names = [self.filename] if self.members is None else self.members
+        is3D = all(get_reader(n)[0] != read_smiles for n in names) or self.gen3D
 
         with transaction(self.conn) as cur:
             cur.execute("""
-            INSERT INTO file (text_id, name, created_at, gen3D, is3D, desalt, phase)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
+            INSERT INTO file (text_id, name, created_at, gen3D, is3D, desalt, embed, profile,
+                              phase)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
             """, (self.text_id, self.filename, int(time.time()), self.gen3D,
-                  is3D, self.desalt, Phase.PENDING.value))
+                  is3D, self.desalt, json.dumps(self.embed, sort_keys=True), self.profile,
+                  Phase.PENDING.value))
             self.file_id = cur.lastrowid
 
     def on_task_start(self):
         with transaction(self.conn) as cur:
             cur.execute(
-                "UPDATE file SET phase = ? WHERE id = ?",
-                (Phase.IN_PROGRESS.value, self.file_id), )
+                "UPDATE file SET phase = ?, parse_started_at = ? WHERE id = ?",
+                (Phase.IN_PROGRESS.value, time.time(), self.file_id), )
 
     def on_job_end(self, job, v):
         self.mols, errors = v
+        MOLECULES.inc(len(self.mols), phase="parse")
         with transaction(self.conn) as cur:
             cur.execute(
-                "UPDATE file SET total = ? WHERE id = ?",
-                (len(self.mols), self.file_id), )
+                "UPDATE file SET total = ?, parse_finished_at = ? WHERE id = ?",
+                (len(self.mols), time.time(), self.file_id), )
             for err in errors:
                 cur.execute("""
                 INSERT INTO file_error (file_id, error)
@@ -110,8 +227,8 @@ class ParseTask(SingleTask):
 
         with transaction(self.conn) as cur:
             cur.execute(
-                "UPDATE file SET phase = ?, total = 0 WHERE id = ?",
-                (Phase.ERROR.value, self.file_id, ), )
+                "UPDATE file SET phase = ?, total = 0, parse_finished_at = ? WHERE id = ?",
+                (Phase.ERROR.value, time.time(), self.file_id, ), )
 
             cur.execute(
                 "INSERT INTO file_error (file_id, error) VALUES (?, ?)",
@@ -121,31 +238,81 @@ class ParseTask(SingleTask):
         if not hasattr(self, "mols"):
             return
 
-        return PrepareTask(
+        task = PrepareTask(
             file_id=self.file_id,
             mols=self.mols,
             gen3D=self.gen3D,
             desalt=self.desalt,
+            embed=self.embed,
+            embed_threads=self.embed_threads,
             conn=self.conn,
-            timeout=self.prepare_timeout, )
+            image_cache=self.image_cache,
+            conformer_cache=self.conformer_cache,
+            timeout=self.prepare_timeout,
+            cost_model=self.cost_model,
+            profile=self.profile, )
+        task.get_conformers()
+        return task
 
     def job(self):
+        use_cache = self.gen3D and self.conformer_cache is not None
+
         return ParseJob(
             body=self.body,
-            reader=self.reader,
-            molecule_limit=self.molecule_limit, )
+            filename=self.filename,
+            members=self.members,
+            molecule_limit=self.molecule_limit,
+            size_limit=self.size_limit,
+            desalt=self.desalt,
+            conformer_params=embed_signature(self.embed) if use_cache else None, )
 
 
 class ParseJob(object):
-    def __init__(self, body, reader, molecule_limit):
+    """Parse an uploaded file, or the members of an uploaded zip archive.
+
+    Compressed files are decompressed while reading, up to size_limit bytes
+    in total.
+    """
+
+    def __init__(self, body, filename, molecule_limit, size_limit, desalt=False,
+                 conformer_params=None, members=None):
         self.body = body
-        self.reader = reader
+        self.filename = filename
+        self.members = members
         self.molecule_limit = molecule_limit
+        self.size_limit = max(size_limit, len(body))
+        self.desalt = desalt
+        self.conformer_params = conformer_params
+
+    def key(self, mol):
+        if self.conformer_params is None:
+            return None
+
+        if self.desalt:
+            mol = desalt(mol)
+
+        return conformer_key(mol, self.conformer_params)
+
+    def records(self):
+        if self.members is None:
+            reader, f = open_input(BytesIO(self.body), self.filename, self.size_limit)
+            yield from reader(f)
+            f.raw.check()
+            return
+
+        limit = self.size_limit
+        with zipfile.ZipFile(BytesIO(self.body)) as archive:
+            for name in self.members:
+                with archive.open(name) as member:
+                    reader, f = open_input(member, name, limit)
+                    yield from reader(f)
+                    f.raw.check()
+                    limit -= f.raw.count
 
     def __call__(self):
         mols, errors = [], []
         nth = 0
-        for i, (mol, name) in enumerate(self.reader(self.body)):
+        for i, (mol, name) in enumerate(self.records()):
             if self.molecule_limit is not None and i >= self.molecule_limit:
                 errors.append(
                     "number of molecule limit: using first {} molecules".
@@ -157,33 +324,85 @@ class ParseJob(object):
                 errors.append(mol)
                 continue
 
-            mols.append((mol, nth, name.strip()))
+            mols.append((mol, nth, name.strip(), self.key(mol)))
             nth += 1
 
         return mols, errors
 
 
 class PrepareTask(Task):
-    def __init__(self, file_id, mols, gen3D, desalt, conn, timeout):
+    phase = "prepare"
+
+    def __init__(self, file_id, mols, gen3D, desalt, embed, embed_threads, conn, image_cache,
+                 conformer_cache, timeout, cost_model=None, profile=False):
         self.file_id = file_id
         self.mols = mols
         self.gen3D = gen3D
         self.desalt = desalt
+        self.embed = embed
+        self.embed_threads = embed_threads
         self.conn = conn
+        self.image_cache = image_cache
+        self.conformer_cache = conformer_cache
         self.timeout = timeout
+        self.cost_model = cost_model
+        self.profile = profile
+        self.conformers = {}
+        self.ordered = False
+
+    def get_conformers(self):
+        keys = {key for _, _, _, key in self.mols if key is not None}
+        if keys:
+            self.conformers = self.conformer_cache.get_many(keys)
+
+    def order(self):
+        """Embed the costliest molecules first, and those with cached conformers last.
+
+        Runs on a worker thread before the first job.
+        """
+        self.ordered = True
+        if self.cost_model is None or not self.gen3D:
+            return
+
+        cached = [m for m in self.mols if m[3] in self.conformers]
+        self.mols = self.cost_model.order(
+            [m for m in self.mols if m[3] not in self.conformers], "prepare_3D") + cached
+
+    def on_task_start(self):
+        with transaction(self.conn) as cur:
+            cur.execute(
+                "UPDATE file SET prepare_started_at = ? WHERE id = ?",
+                (time.time(), self.file_id), )
 
     def on_job_end(self, job, result):
-        uff, mol, nth, name = result
+        profiled = None
+        if isinstance(result, Profiled):
+            profiled, result = result, result.value
+
+        uff, mol, nth, name, cached = result
+        MOLECULES.inc(phase="prepare")
         if self.gen3D:
             ff = "UFF" if uff else "MMFF"
         else:
             ff = None
+
+        if job.key is not None:
+            self.conformer_cache.record(cached)
+            if not cached:
+                self.conformer_cache.put(job.key, ff, mol)
+
         with transaction(self.conn) as cur:
             cur.execute("""
             INSERT INTO molecule (file_id, nth, forcefield, name, mol)
             VALUES (?, ?, ?, ?, ?)
             """, (self.file_id, nth, ff, name, mol))
 
+            if profiled is not None:
+                record_profile(
+                    cur, job, profiled, "prepare",
+                    file_id=self.file_id,
+                    molecule_id=cur.lastrowid, )
+
     def on_job_error(self, job, err):
         se = str(err)
         if len(se) == 0:
@@ -200,15 +419,40 @@ class PrepareTask(Task):
     def on_task_end(self):
         with transaction(self.conn) as cur:
             cur.execute(
-                "UPDATE file SET phase = ? WHERE id = ?",
-                (Phase.DONE.value, self.file_id), )
+                "UPDATE file SET phase = ?, prepare_finished_at = ? WHERE id = ?",
+                (Phase.DONE.value, time.time(), self.file_id), )
+
+    def next_task(self):
+        task = GridTask(
+            file_id=self.file_id,
+            start=0,
+            stop=GRID_COUNT,
+            cols=GRID_COLS,
+            size=GRID_SIZE,
+            ext="png",
+            conn=self.conn,
+            image_cache=self.image_cache, )
+        task.get_mols()
+        if len(task.mols) == 0:
+            return
+
+        return task
 
     def __next__(self):
+        if not self.ordered:
+            self.order()
+
         if len(self.mols) == 0:
             raise StopIteration
 
-        (mol, nth, name), self.mols = self.mols[0], self.mols[1:]
-        return PrepareJob(mol, nth, name, self.gen3D, self.desalt)
+        (mol, nth, name, key), self.mols = self.mols[0], self.mols[1:]
+        return PrepareJob(
+            mol, nth, name, self.gen3D, self.desalt,
+            embed=self.embed,
+            threads=self.embed_threads,
+            key=key,
+            conformer=self.conformers.get(key),
+            profile=self.profile, )
 
 
 def desalt(mol):
@@ -227,9 +471,59 @@ def optimize(mol, f):
     raise ValueError("{} optimize not converged".format(f.__name__))
 
 
-def gen3D(mol):
+EMBED_METHODS = {"default", "etkdg"}
+MAX_CONFORMERS = 100
+
+DEFAULT_EMBED = {
+    "conformers": 1,
+    "method": "default",
+    "seed": -1,
+}
+
+
+def embed_signature(embed):
+    """Identify the conformers gen3D produces with embed in the conformer cache."""
+    return "{method};seed={seed};conformers={conformers};MMFF,UFF;maxIters=1000x10".format(
+        **embed)
+
+
+def lowest_energy(mol, f, threads):
+    results = f(mol, numThreads=threads, maxIters=1000)
+    converged = [(e, i) for i, (nc, e) in enumerate(results) if nc == 0]
+    if not converged:
+        raise ValueError("{} optimize not converged".format(f.__name__))
+
+    _, i = min(converged)
+    conf = Chem.Conformer(mol.GetConformer(mol.GetConformers()[i].GetId()))
+    mol.RemoveAllConformers()
+    mol.AddConformer(conf, assignId=True)
+
+
+def gen3D_multi(mol, embed, threads):
+    params = ETKDGv3()
+    params.randomSeed = embed["seed"]
+    params.numThreads = threads
+
+    if len(EmbedMultipleConfs(mol, embed["conformers"], params)) == 0:
+        raise ValueError("EmbedMultipleConfs failed")
+
+    if MMFFHasAllMoleculeParams(mol):
+        try:
+            lowest_energy(mol, MMFFOptimizeMoleculeConfs, threads)
+            return False, mol
+        except ValueError:
+            pass
+
+    lowest_energy(mol, UFFOptimizeMoleculeConfs, threads)
+    return True, mol
+
+
+def gen3D(mol, embed=DEFAULT_EMBED, threads=1):
     mol = Chem.AddHs(mol)
-    if EmbedMolecule(mol) != 0:
+    if embed["method"] != "default" or embed["conformers"] > 1:
+        return gen3D_multi(mol, embed, threads)
+
+    if EmbedMolecule(mol, randomSeed=embed["seed"]) != 0:
         raise ValueError("EmbedMolecule failed")
 
     uff = False
@@ -246,32 +540,67 @@ def gen3D(mol):
 
 
 class PrepareJob(object):
-    def __init__(self, mol, nth, name, gen3D, desalt):
+    def __init__(self, mol, nth, name, gen3D, desalt, embed=DEFAULT_EMBED, threads=1,
+                 key=None, conformer=None, profile=False):
         self.mol = mol
         self.nth = nth
         self.name = name
         self.gen3D = gen3D
         self.desalt = desalt
+        self.embed = embed
+        self.threads = threads
+        self.key = key
+        self.conformer = conformer
+        self.profile = profile
+        self.submitted_at = time.time()
 
     def __call__(self):
+        if self.profile:
+            return run_profiled(self.run)
+
+        return self.run()
+
+    def run(self):
         mol = self.mol
         if self.desalt:
             mol = desalt(mol)
 
-        if self.gen3D:
-            uff, mol = gen3D(mol)
-            return uff, mol, self.nth, self.name
-        else:
-            return None, mol, self.nth, self.name
+        if not self.gen3D:
+            return None, mol, self.nth, self.name, False
+
+        if self.conformer is not None:
+            forcefield, cached = self.conformer
+            cached = apply_conformer(mol, cached)
+            if cached is not None:
+                return forcefield == "UFF", cached, self.nth, self.name, True
+
+        uff, mol = gen3D(mol, self.embed, self.threads)
+        return uff, mol, self.nth, self.name, False
 
 
 class FileHandler(RequestHandler):
-    SMI_EXT = {".smi", ".smiles"}
-    SDF_EXT = {".sdf", ".sd", ".mol"}
+    def get_embed(self):
+        embed = dict(DEFAULT_EMBED)
+        embed["method"] = self.get_argument("embed", embed["method"])
+        if embed["method"] not in EMBED_METHODS:
+            self.fail(400, "unknown embed method: {}".format(embed["method"]))
+
+        try:
+            embed["seed"] = int(self.get_argument("seed", embed["seed"]))
+            embed["conformers"] = int(self.get_argument("conformers", embed["conformers"]))
+        except ValueError:
+            self.fail(400, "seed and conformers must be integer")
+
+        if not 1 <= embed["conformers"] <= MAX_CONFORMERS:
+            self.fail(400, "conformers must be in 1-{}".format(MAX_CONFORMERS))
+
+        return embed
 
     def post(self):
         gen3D = self.get_flag("gen3D", False)
         desalt = self.get_flag("desalt", True)
+        embed = self.get_embed()
+        profile = self.get_flag("profile", False)
 
         f = self.request.files.get("file")
         if f is None:
@@ -283,31 +612,62 @@ class FileHandler(RequestHandler):
         if len(f.body) > limit_b:
             self.fail(400, "file size too large (> {}MB)".format(limit_mb))
 
-        ext = os.path.splitext(f.filename)[-1].lower()
+        if not is_archive(f.filename):
+            if get_reader(f.filename)[0] is None:
+                self.fail(400, "unknown extension: {}".format(
+                    os.path.splitext(f.filename)[-1].lower()))
 
-        if ext in self.SMI_EXT:
-            reader = read_smiles
-        elif ext in self.SDF_EXT:
-            reader = read_sdf
+            text_id = self.parse(f.filename, f.body, gen3D, desalt, embed, profile)
+            return self.json(id=text_id)
+
+        split = self.get_argument("archive", "merge")
+        if split not in {"merge", "split"}:
+            self.fail(400, "archive must be merge or split")
+
+        try:
+            with zipfile.ZipFile(BytesIO(f.body)) as archive:
+                members, skipped = archive_members(archive)
+        except zipfile.BadZipFile as e:
+            self.fail(400, "invalid zip archive: {}".format(e))
+
+        if not members:
+            self.fail(400, "no molecule file in archive")
+
+        if split == "merge":
+            ids = [self.parse(f.filename, f.body, gen3D, desalt, embed, profile, members)]
+        elif len(members) > MAX_ARCHIVE_FILES:
+            self.fail(400, "too many files in archive (> {})".format(MAX_ARCHIVE_FILES))
         else:
-            self.fail(400, "unknown extension: {}".format(ext))
+            ids = [
+                self.parse("{}/{}".format(f.filename, name), f.body, gen3D, desalt, embed,
+                           profile, [name]) for name in members
+            ]
+
+        self.json(id=ids[0], ids=ids, skipped=skipped)
 
+    def parse(self, filename, body, gen3D, desalt, embed, profile, members=None):
         text_id = issue_text_id()
         task = ParseTask(
             text_id=text_id,
-            filename=f.filename,
-            body=f.body,
+            filename=filename,
+            body=body,
             gen3D=gen3D,
             desalt=desalt,
+            embed=embed,
+            embed_threads=self.application.embed_threads,
             conn=self.db,
-            reader=reader,
+            image_cache=self.application.image_cache,
+            conformer_cache=self.application.conformer_cache,
             parse_timeout=self.application.parse_timeout,
             prepare_timeout=self.application.prepare_timeout,
-            molecule_limit=self.application.molecule_limit, )
+            molecule_limit=self.application.molecule_limit,
+            size_limit=self.application.decompressed_size_limit * MEGA,
+            members=members,
+            cost_model=self.application.cost_model,
+            profile=profile, )
         task.insert_file()
         self.put(task)
-
-        self.json(id=text_id)
+        return text_id
 
 
 class FileIdHandler(SSEHandler):
@@ -330,9 +690,19 @@ class FileIdHandler(SSEHandler):
         else:
             return self.get_json(id)
 
+    TIMESTAMPS = ("created_at", "parse_started_at", "parse_finished_at", "prepare_started_at",
+                  "prepare_finished_at")
+
+    def get_timestamps(self, cur):
+        cur.execute(
+            "SELECT {} FROM file WHERE id = ? LIMIT 1".format(", ".join(self.TIMESTAMPS)),
+            (self.file_id, ), )
+        return dict(zip(self.TIMESTAMPS, cur.fetchone()))
+
     @gen.coroutine
     def get_sse(self, id):
         self.init_sse()
+        eta = Eta()
         while True:
             with self.transaction() as cur:
                 cur.execute("""
@@ -343,9 +713,15 @@ class FileIdHandler(SSEHandler):
                 """, (self.file_id, ))
 
                 total, phase, current = cur.fetchone()
+                timestamps = self.get_timestamps(cur)
 
             yield self.publish(
-                total=total, name=self.filename, phase=phase, current=current)
+                total=total,
+                name=self.filename,
+                phase=phase,
+                current=current,
+                eta=eta.update(current, total, timestamps["prepare_started_at"]),
+                **timestamps)
             if phase == Phase.ERROR.value or phase == Phase.DONE.value:
                 raise web.Finish
             yield gen.sleep(0.5)
@@ -353,33 +729,78 @@ class FileIdHandler(SSEHandler):
     def get_json(self, id):
         with self.transaction() as cur:
             cur.execute(
-                "SELECT name, gen3D, is3D, desalt, phase FROM file WHERE id = ? LIMIT 1",
+                "SELECT name, gen3D, is3D, desalt, embed, phase FROM file WHERE id = ? LIMIT 1",
                 (self.file_id, ), )
-            name, gen3D, is3D, desalt, phase = cur.fetchone()
+            name, gen3D, is3D, desalt, embed, phase = cur.fetchone()
 
             cur.execute(
-                "SELECT name, forcefield FROM molecule WHERE file_id = ? ORDER BY nth",
+                "SELECT nth, name, forcefield FROM molecule WHERE file_id = ? ORDER BY nth",
                 (self.file_id, ), )
-            mols = [{"name": n, "forcefield": f} for n, f in cur.fetchall()]
+            mols = [{"forcefield": f, "name": n, "nth": nth} for nth, n, f in cur.fetchall()]
 
             cur.execute(
                 "SELECT error FROM file_error WHERE file_id = ? ORDER BY id",
                 (self.file_id, ), )
             errors = [e for e, in cur.fetchall()]
 
+            timestamps = self.get_timestamps(cur)
+
         self.json(
             name=name,
             gen3D=bool(gen3D),
             desalt=bool(desalt),
+            embed=json.loads(embed) if embed else DEFAULT_EMBED,
             is3D=bool(is3D),
             mols=mols,
             errors=errors,
-            phase=phase, )
+            phase=phase,
+            **timestamps)
+
+
+def write_sdf(rows):
+    bio = StringIO()
+    writer = Chem.SDWriter(bio)
+    for name, mol, forcefield in rows:
+        mol.SetProp("_Name", name)
+        if forcefield:
+            mol.SetProp("ForceField", forcefield)
+
+        writer.write(mol)
+
+    writer.close()
+    return bio.getvalue()
+
+
+def write_smi(rows):
+    return "".join(
+        "{} {}\n".format(Chem.MolToSmiles(Chem.RemoveHs(mol)), name)
+        for name, mol, _ in rows)
+
+
+class ExportJob(object):
+    WRITERS = {
+        "sdf": write_sdf,
+        "smi": write_smi,
+    }
+
+    def __init__(self, rows, ext):
+        self.rows = rows
+        self.ext = ext
+
+    def __call__(self):
+        return self.WRITERS[self.ext](self.rows)
 
 
 class FileIdExtHandler(RequestHandler):
     EXTS = {"sdf", "smi"}
+    CONTENT_TYPES = {
+        "sdf": "chemical/x-mdl-sdfile",
+        "smi": "chemical/x-daylight-smiles",
+    }
 
+    BATCH_SIZE = 100
+
+    @gen.coroutine
     def get(self, text_id, ext):
         ext = ext.lower()
         if ext not in self.EXTS:
@@ -394,53 +815,143 @@ class FileIdExtHandler(RequestHandler):
 
             file_id, = result
 
+        self.set_header("content-type", self.CONTENT_TYPES[ext])
+
+        # convert a batch on the worker pool while the next one is read
+        nth, rows = self.fetch_batch(file_id, -1)
+        while rows:
+            fut = self.application.queue.submit(ExportJob(rows, ext))
+            nth, rows = self.fetch_batch(file_id, nth)
+
+            self.write((yield fut))
+            try:
+                yield self.flush()
+            except iostream.StreamClosedError:
+                return
+
+    def fetch_batch(self, file_id, after):
+        with self.transaction() as cur:
             cur.execute("""
-            SELECT name, mol, forcefield
+            SELECT nth, name, mol, forcefield
             FROM molecule
-            WHERE file_id = ?
+            WHERE file_id = ? AND nth > ?
             ORDER BY nth
-            """, (file_id, ))
-
-            if ext == "sdf":
-                self.get_sdf(cur)
-            elif ext == "smi":
-                self.get_smi(cur)
-            else:
-                self.fail(500, "BUG: unknown extension: {}".format(ext))
-
-    def get_sdf(self, cur):
-        self.set_header("content-type", "chemical/x-mdl-sdfile")
-        with NamedTemporaryFile() as temp:
-            writer = Chem.SDWriter(temp.name)
-            while True:
-                result = cur.fetchone()
-                if result is None:
-                    break
-
-                name, mol, forcefield = result
-                mol.SetProp("_Name", name)
-                if forcefield:
-                    mol.SetProp("ForceField", forcefield)
-
-                writer.write(mol)
-
-            writer.close()
-            temp.seek(0)
-            self.write(temp.read())
-
-    def get_smi(self, cur):
-        self.set_header("content-type", "chemical/x-daylight-smiles")
-        while True:
-            result = cur.fetchone()
-            if result is None:
-                break
+            LIMIT ?
+            """, (file_id, after, self.BATCH_SIZE))
+            result = cur.fetchall()
+
+        if not result:
+            return after, []
+
+        return result[-1][0], [r[1:] for r in result]
+
+
+def draw(mol, size, ext):
+    mol = Chem.Mol(mol)
+    mol.RemoveAllConformers()
+
+    if ext == "svg":
+        mol = Draw.rdMolDraw2D.PrepareMolForDrawing(mol)
+        drawer = Draw.rdMolDraw2D.MolDraw2DSVG(size, size)
+        drawer.DrawMolecule(mol)
+        drawer.FinishDrawing()
+        return drawer.GetDrawingText().encode("UTF-8")
+
+    img = Draw.MolToImage(mol, size=(size, size))
+    bio = BytesIO()
+    img.save(bio, format="png")
+    return bio.getvalue()
+
+
+class RenderJob(object):
+    def __init__(self, mol, size, ext):
+        self.mol = mol
+        self.size = size
+        self.ext = ext
+
+    def __call__(self):
+        return draw(self.mol, self.size, self.ext)
+
+
+class GridTask(SingleTask):
+    """Render a grid image of prepared molecules into the image cache."""
+
+    phase = "render"
+
+    def __init__(self, file_id, start, stop, cols, size, ext, conn, image_cache):
+        self.file_id = file_id
+        self.start = start
+        self.stop = stop
+        self.cols = cols
+        self.size = size
+        self.ext = ext
+        self.conn = conn
+        self.image_cache = image_cache
+
+    @property
+    def key(self):
+        return "grid", self.file_id, self.start, self.stop, self.cols, self.size, self.ext
+
+    def get_mols(self):
+        with transaction(self.conn) as cur:
+            cur.execute("""
+            SELECT nth, name, mol
+            FROM molecule
+            WHERE file_id = ? AND nth >= ? AND nth < ?
+            ORDER BY nth""", (self.file_id, self.start, self.stop))
+            self.mols = cur.fetchall()
+
+    def on_job_end(self, job, v):
+        self.image_cache.put(self.key, v)
+
+    def job(self):
+        return GridJob(
+            mols=[m for _, _, m in self.mols],
+            names=[n for _, n, _ in self.mols],
+            cols=self.cols,
+            size=self.size,
+            ext=self.ext, )
+
 
-            name, mol, _ = result
-            self.write("{} {}\n".format(Chem.MolToSmiles(Chem.RemoveHs(mol)), name))
+class GridJob(object):
+    def __init__(self, mols, names, cols, size, ext):
+        self.mols = mols
+        self.names = names
+        self.cols = cols
+        self.size = size
+        self.ext = ext
+
+    def __call__(self):
+        mols = []
+        for mol in self.mols:
+            mol = Chem.Mol(mol)
+            mol.RemoveAllConformers()
+            mols.append(mol)
+
+        img = Draw.MolsToGridImage(
+            mols,
+            molsPerRow=self.cols,
+            subImgSize=(self.size, self.size),
+            legends=self.names,
+            useSVG=self.ext == "svg", )
+
+        if self.ext == "svg":
+            return img.encode("UTF-8")
+
+        bio = BytesIO()
+        img.save(bio, format="png")
+        return bio.getvalue()
 
 
 class FileIdNthExtHandler(RequestHandler):
-    EXTS = {"png", "mol"}
+    EXTS = {"png", "svg", "mol"}
+    CONTENT_TYPES = {
+        "png": "image/png",
+        "svg": "image/svg+xml",
+    }
+
+    MIN_SIZE = 32
+    MAX_SIZE = 1024
 
     def get(self, id, nth, ext):
         ext = ext.lower()
@@ -451,7 +962,7 @@ class FileIdNthExtHandler(RequestHandler):
 
         with self.transaction() as cur:
             cur.execute("""
-            SELECT name, mol, forcefield
+            SELECT id, name, forcefield
             FROM molecule
             WHERE nth = ?
             AND file_id = (SELECT id FROM FILE WHERE text_id = ?)
@@ -462,23 +973,119 @@ class FileIdNthExtHandler(RequestHandler):
         if result is None:
             self.fail(404, "not found")
 
-        self.name, self.mol, self.forcefield = result
+        self.mol_id, self.name, self.forcefield = result
 
-        if ext == "png":
-            self.get_png()
+        if ext in self.CONTENT_TYPES:
+            return self.get_image(ext)
         elif ext == "mol":
             self.get_mol()
         else:
             self.fail(500, "BUG: unknown extension: {}".format(ext))
 
-    def get_png(self):
-        self.mol.RemoveAllConformers()
-        img = Draw.MolToImage(self.mol, size=(400, 400))
-        bio = BytesIO()
-        img.save(bio, format="png")
+    def get_molecule(self):
+        with self.transaction() as cur:
+            cur.execute("SELECT mol FROM molecule WHERE id = ?", (self.mol_id, ))
+            mol, = cur.fetchone()
+
+        return mol
 
-        self.set_header("Content-Type", "image/png")
-        self.write(bio.getvalue())
+    @gen.coroutine
+    def get_image(self, ext):
+        try:
+            size = int(self.get_argument("size", 400))
+        except ValueError:
+            self.fail(400, "size must be integer")
+
+        if not self.MIN_SIZE <= size <= self.MAX_SIZE:
+            self.fail(400, "size must be in {}-{}".format(self.MIN_SIZE, self.MAX_SIZE))
+
+        key = self.mol_id, size, ext
+        cache = self.application.image_cache
+        data = cache.get(key)
+        if data is None:
+            data = yield self.application.queue.submit(
+                RenderJob(self.get_molecule(), size, ext))
+            cache.put(key, data)
+
+        self.set_header("Content-Type", self.CONTENT_TYPES[ext])
+        self.set_header("Cache-Control", "public, max-age=31536000, immutable")
+        self.write(data)
 
     def get_mol(self):
-        self.write(Chem.MolToMolBlock(self.mol))
+        self.write(Chem.MolToMolBlock(self.get_molecule()))
+
+
+class FileIdGridHandler(RequestHandler):
+    """Grid image of the molecules whose nth is in [start, stop)."""
+
+    # the scheduler holds the grids pre-rendered by GridTask
+    PROXY_METHODS = {"GET"}
+
+    def get_int(self, name, default, vmin, vmax):
+        try:
+            v = int(self.get_argument(name, default))
+        except ValueError:
+            self.fail(400, "{} must be integer".format(name))
+
+        if not vmin <= v <= vmax:
+            self.fail(400, "{} must be in {}-{}".format(name, vmin, vmax))
+
+        return v
+
+    @gen.coroutine
+    def get(self, id, start, stop, ext):
+        ext = ext.lower()
+        if ext not in FileIdNthExtHandler.CONTENT_TYPES:
+            self.fail(400, "unknown extension")
+
+        start, stop = int(start), int(stop)
+        if not 0 < stop - start <= GRID_MAX:
+            self.fail(400, "number of molecules must be in 1-{}".format(GRID_MAX))
+
+        cols = self.get_int("cols", GRID_COLS, 1, GRID_MAX)
+        size = self.get_int(
+            "size", GRID_SIZE, FileIdNthExtHandler.MIN_SIZE, FileIdNthExtHandler.MAX_SIZE)
+
+        with self.transaction() as cur:
+            cur.execute("SELECT id, phase FROM file WHERE text_id = ? LIMIT 1", (id, ))
+            result = cur.fetchone()
+            if result is None:
+                self.fail(404, "not found")
+
+            file_id, phase = result
+
+            cur.execute(
+                "SELECT nth FROM molecule WHERE file_id = ? AND nth >= ? AND nth < ? ORDER BY nth",
+                (file_id, start, stop), )
+            nths = [n for n, in cur.fetchall()]
+
+        if len(nths) == 0:
+            self.fail(404, "not found")
+
+        task = GridTask(
+            file_id=file_id,
+            start=start,
+            stop=stop,
+            cols=cols,
+            size=size,
+            ext=ext,
+            conn=self.db,
+            image_cache=self.application.image_cache, )
+
+        # molecules of a prepared file never change
+        done = phase == Phase.DONE.value
+        cache = self.application.image_cache
+        data = cache.get(task.key) if done else None
+
+        if data is None:
+            task.get_mols()
+            data = yield self.application.queue.submit(task.job())
+            if done:
+                cache.put(task.key, data)
+
+        if done:
+            self.set_header("Cache-Control", "public, max-age=31536000, immutable")
+
+        self.set_header("Content-Type", FileIdNthExtHandler.CONTENT_TYPES[ext])
+        self.set_header("X-Molecule-Nth", ",".join(str(n) for n in nths))
+        self.write(data)
@@ -0,0 +1,45 @@
+"""Heavy modules imported on first use, so the server binds its port early.
+
+mordred imports all descriptor modules, and openpyxl, pyarrow and the RDKit
+drawing code take as long again; most requests need none of them.
+"""
+
+import importlib
+import importlib.util
+
+
+class LazyModule(object):
+    """Proxy of a module that is imported on first attribute access.
+
+    Submodules that the module does not import itself are imported as
+    attributes, e.g. LazyModule("pyarrow").parquet.
+    """
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        if attr == "_name":
+            raise AttributeError(attr)
+
+        module = importlib.import_module(self._name)
+        try:
+            return getattr(module, attr)
+        except AttributeError:
+            pass
+
+        try:
+            return importlib.import_module("{}.{}".format(self._name, attr))
+        except ImportError:
+            raise AttributeError("module {!r} has no attribute {!r}".format(self._name, attr))
+
+    def __repr__(self):
+        return "<lazy module {!r}>".format(self._name)
+
+
+def lazy_import(name):
+    """Return a LazyModule of name, or None if it is not installed."""
+    if importlib.util.find_spec(name) is None:
+        return None
+
+    return LazyModule(name)
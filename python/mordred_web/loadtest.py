@@ -0,0 +1,352 @@
+"""HTTP load test of a local server.
+
+Virtual users upload a file, watch its progress, fetch thumbnails, calculate,
+watch the calculation and download the exports, over and over for a given
+time; the latency and error rate of each endpoint are reported.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import uuid
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+import urllib.parse
+from collections import Counter, defaultdict
+
+import tornado.ioloop
+from tornado import gen
+from tornado.httpclient import HTTPError, AsyncHTTPClient
+
+from .bench import environment
+from .__main__ import serve, get_free_address
+
+PERCENTILES = (50, 95, 99)
+
+
+class Failed(Exception):
+    pass
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted values."""
+    return values[max(int(math.ceil(p / 100 * len(values))) - 1, 0)]
+
+
+class Stats(object):
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(Counter)
+
+    def record(self, endpoint, seconds, error=None):
+        if error is None:
+            self.latencies[endpoint].append(seconds)
+        else:
+            self.errors[endpoint][error] += 1
+
+    def report(self, elapsed):
+        rows = []
+        for endpoint in sorted(set(self.latencies) | set(self.errors)):
+            latencies = sorted(self.latencies[endpoint])
+            errors = sum(self.errors[endpoint].values())
+            requests = len(latencies) + errors
+            row = {
+                "endpoint": endpoint,
+                "error_rate": errors / requests,
+                "errors": dict(self.errors[endpoint]),
+                "requests": requests,
+                "requests_per_second": requests / elapsed,
+            }
+            for p in PERCENTILES:
+                row["p{}".format(p)] = percentile(latencies, p) if latencies else None
+
+            rows.append(row)
+
+        return rows
+
+
+def multipart(path):
+    boundary = uuid.uuid4().hex
+    with open(path, "rb") as f:
+        body = b"".join([
+            "--{}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{}\"\r\n"
+            "Content-Type: application/octet-stream\r\n\r\n".format(
+                boundary, os.path.basename(path)).encode("UTF-8"),
+            f.read(),
+            "\r\n--{}--\r\n".format(boundary).encode("UTF-8"),
+        ])
+
+    return body, "multipart/form-data; boundary=" + boundary
+
+
+class LoadTest(object):
+    """Run sessions of virtual users against base until the deadline."""
+
+    def __init__(self, base, args):
+        self.base = base
+        self.args = args
+        self.stats = Stats()
+        self.sessions = 0
+        self.body, self.content_type = multipart(args.input)
+        self.query = urllib.parse.urlencode({"gen3D": str(args.gen3D).lower()})
+        self.calc_body = urllib.parse.urlencode([("descriptor", d) for d in args.descriptor])
+
+        # no client side queueing, which would be counted as latency
+        max_clients = args.concurrency * (2 + 2 * args.watchers + args.thumbnails)
+        self.client = AsyncHTTPClient(force_instance=True, max_clients=max_clients)
+
+    @gen.coroutine
+    def fetch(self, endpoint, path, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = yield self.client.fetch(
+                self.base + path, request_timeout=self.args.timeout, **kwargs)
+        except HTTPError as e:
+            self.stats.record(endpoint, None, error=str(e.code))
+            raise Failed
+        except Exception as e:
+            self.stats.record(endpoint, None, error=type(e).__name__)
+            raise Failed
+
+        self.stats.record(endpoint, time.perf_counter() - start)
+        raise gen.Return(response)
+
+    @gen.coroutine
+    def watch(self, endpoint, path):
+        """Subscribe to the events of path until the server closes the stream.
+
+        The time to the first event is recorded, and the last event returned.
+        """
+        start = time.perf_counter()
+        first = []
+        chunks = []
+
+        def on_chunk(chunk):
+            if not first:
+                first.append(time.perf_counter() - start)
+            chunks.append(chunk)
+
+        try:
+            yield self.client.fetch(
+                self.base + path, headers={"Accept": "text/event-stream"},
+                streaming_callback=on_chunk, request_timeout=self.args.timeout)
+        except HTTPError as e:
+            self.stats.record(endpoint, None, error=str(e.code))
+            raise Failed
+        except Exception as e:
+            self.stats.record(endpoint, None, error=type(e).__name__)
+            raise Failed
+
+        events = [e for e in b"".join(chunks).decode("UTF-8").split("\n\n") if e]
+        if not events:
+            self.stats.record(endpoint, None, error="no event")
+            raise Failed
+
+        self.stats.record(endpoint, first[0])
+        raise gen.Return(json.loads(events[-1][len("data: "):]))
+
+    @gen.coroutine
+    def watch_all(self, endpoint, path):
+        """Watch path with the extra watchers, returning the session's last event."""
+        extra = [self.watch(endpoint, path) for _ in range(self.args.watchers)]
+        try:
+            event = yield self.watch(endpoint, path)
+        finally:
+            yield gen.multi(extra, quiet_exceptions=Failed)
+
+        raise gen.Return(event)
+
+    @gen.coroutine
+    def session(self):
+        response = yield self.fetch(
+            "POST /api/file", "/api/file?" + self.query, method="POST", body=self.body,
+            headers={"Content-Type": self.content_type})
+        file_id = json.loads(response.body)["id"]
+
+        event = yield self.watch_all("SSE /api/file/:id", "/api/file/" + file_id)
+        if event["phase"] != "done":
+            self.stats.record("SSE /api/file/:id", None, error=event["phase"])
+            raise Failed
+
+        yield [self.fetch("GET /api/file/:id/:n.png", "/api/file/{}/{}.png".format(file_id, n))
+               for n in range(min(self.args.thumbnails, event["total"]))]
+
+        response = yield self.fetch(
+            "POST /api/calc/:id", "/api/calc/" + file_id, method="POST", body=self.calc_body)
+        calc_id = json.loads(response.body)["id"]
+
+        yield self.watch_all("SSE /api/calc/:id", "/api/calc/" + calc_id)
+
+        for ext in self.args.exports:
+            yield self.fetch("GET /api/calc/:id." + ext, "/api/calc/{}.{}".format(calc_id, ext))
+
+        self.sessions += 1
+
+    @gen.coroutine
+    def user(self, deadline):
+        while time.perf_counter() < deadline:
+            try:
+                yield self.session()
+            except Failed:
+                pass
+
+    @gen.coroutine
+    def run(self):
+        start = time.perf_counter()
+        deadline = start + self.args.duration
+        yield [self.user(deadline) for _ in range(self.args.concurrency)]
+        raise gen.Return(time.perf_counter() - start)
+
+
+def run_server(log, options):
+    """Run serve() with its output redirected to log."""
+    fd = os.open(log, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+    serve(**options)
+
+
+class LocalServer(object):
+    """serve() in a child process on a free port, with a temporary database and cache."""
+
+    def __init__(self, workers, frontends, timeout):
+        self.workers = workers
+        self.frontends = frontends
+        self.timeout = timeout
+
+    def __enter__(self):
+        self.tmp = tempfile.mkdtemp(prefix="mordred-web-loadtest-")
+        self.log = os.path.join(self.tmp, "server.log")
+        _, port = get_free_address()
+        self.base = "http://127.0.0.1:{}".format(port)
+        options = {
+            "cache": os.path.join(self.tmp, "cache"),
+            "db": os.path.join(self.tmp, "db.sqlite"),
+            "frontends": self.frontends,
+            "no_browser": True,
+            "port": port,
+            "workers": self.workers,
+        }
+        # not forked, which would share the event loop of this process
+        context = multiprocessing.get_context("spawn")
+        self.proc = context.Process(target=run_server, args=(self.log, options))
+        self.proc.start()
+        return self
+
+    def __exit__(self, *args):
+        self.proc.terminate()
+        self.proc.join()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    @gen.coroutine
+    def wait_ready(self):
+        client = AsyncHTTPClient()
+        start = time.perf_counter()
+        while time.perf_counter() - start < self.timeout:
+            if not self.proc.is_alive():
+                with open(self.log) as f:
+                    raise RuntimeError("server exited with status {}:\n{}".format(
+                        self.proc.exitcode, f.read()))
+
+            try:
+                yield client.fetch(self.base + "/api/ready")
+                raise gen.Return(time.perf_counter() - start)
+            except (HTTPError, ConnectionError):
+                yield gen.sleep(0.1)
+
+        raise RuntimeError("server was not ready in {}s".format(self.timeout))
+
+
+def print_report(rows):
+    print("{:<26} {:>8} {:>7} {:>7} {:>9} {:>9} {:>9}".format(  # noqa: T003
+        "endpoint", "requests", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms"))
+    for row in rows:
+        ms = ["{:>9.1f}".format(row[k] * 1000) if row[k] is not None else "{:>9}".format("-")
+              for k in ("p50", "p95", "p99")]
+        print("{:<26} {:>8} {:>6.1%} {:>7.2f} {}".format(  # noqa: T003
+            row["endpoint"], row["requests"], row["error_rate"], row["requests_per_second"],
+            " ".join(ms)))
+
+
+def load_test(args):
+    ioloop = tornado.ioloop.IOLoop.current()
+
+    def run(base):
+        test = LoadTest(base, args)
+        elapsed = ioloop.run_sync(test.run)
+        return test, elapsed
+
+    if args.url is not None:
+        test, elapsed = run(args.url.rstrip("/"))
+    else:
+        with LocalServer(args.workers, args.frontends, args.timeout) as server:
+            ready = ioloop.run_sync(server.wait_ready)
+            print("server ready in {:.1f}s".format(ready), file=sys.stderr)  # noqa: T003
+            test, elapsed = run(server.base)
+
+    rows = test.stats.report(elapsed)
+    print("{} sessions of {} users in {:.1f}s".format(  # noqa: T003
+        test.sessions, args.concurrency, elapsed))
+    print_report(rows)
+
+    if args.output is not None:
+        report = {
+            "args": {"concurrency": args.concurrency, "descriptor": args.descriptor,
+                     "duration": args.duration, "exports": args.exports,
+                     "frontends": args.frontends, "gen3D": args.gen3D,
+                     "input": os.path.basename(args.input), "thumbnails": args.thumbnails,
+                     "url": args.url, "watchers": args.watchers, "workers": args.workers},
+            "elapsed": elapsed,
+            "environment": environment(),
+            "results": rows,
+            "sessions": test.sessions,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog="mordred_web loadtest",
+        description="Load test a local server with concurrent uploads, calculations, "
+        "event streams, thumbnails and exports")
+    parser.add_argument(
+        "-c", "--concurrency", metavar="N", type=int, default=4,
+        help="number of virtual users, each uploading, calculating and exporting in turn")
+    parser.add_argument(
+        "-d", "--duration", metavar="SEC", type=float, default=60,
+        help="seconds to start new sessions; running sessions are finished")
+    parser.add_argument(
+        "--watchers", metavar="N", type=int, default=2,
+        help="extra event stream subscribers of each file and calculation")
+    parser.add_argument(
+        "--thumbnails", metavar="N", type=int, default=8, help="thumbnails fetched per file")
+    parser.add_argument(
+        "--exports", type=lambda s: [e for e in s.split(",") if e], default=["csv", "xlsx"],
+        help="comma separated export formats downloaded per calculation")
+    parser.add_argument(
+        "--descriptor", action="append", default=None,
+        help="descriptor to calculate (repeatable; default: MW, SLogP, TopoPSA)")
+    parser.add_argument(
+        "--input", required=True,
+        help="uploaded file, e.g. help/examples/example.smi of a checkout")
+    parser.add_argument("--gen3D", action="store_true", help="generate 3D conformers")
+    parser.add_argument(
+        "-w", "--workers", type=int, default=1, help="number of workers of the server")
+    parser.add_argument(
+        "--frontends", type=int, default=1, help="number of front end processes of the server")
+    parser.add_argument(
+        "--url", default=None, help="load test a running server instead of starting one")
+    parser.add_argument(
+        "--timeout", metavar="SEC", type=float, default=300, help="request timeout")
+    parser.add_argument("-o", "--output", default=None, help="also write results as JSON")
+
+    args = parser.parse_args(args)
+    if args.descriptor is None:
+        args.descriptor = ["MW", "SLogP", "TopoPSA"]
+
+    load_test(args)
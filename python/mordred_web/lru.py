@@ -0,0 +1,40 @@
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Byte-size bounded least-recently-used cache of bytes values."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        v = self._items.get(key)
+        if v is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._items.move_to_end(key)
+        return v
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+
+        old = self._items.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+
+        self._items[key] = value
+        self.size += len(value)
+
+        while self.size > self.max_bytes:
+            _, v = self._items.popitem(last=False)
+            self.size -= len(v)
@@ -0,0 +1,162 @@
+import threading
+from bisect import bisect_left
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _escape(v):
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format(name, labels, value):
+    if labels:
+        name += "{{{}}}".format(",".join(
+            '{}="{}"'.format(k, _escape(v)) for k, v in labels))
+
+    return "{} {}\n".format(name, repr(float(value)))
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self):
+        with self.lock:
+            items = sorted(self.values.items())
+
+        for key, value in items:
+            yield self.name, list(zip(self.labels, key)), value
+
+    def render(self):
+        lines = [
+            "# HELP {} {}\n".format(self.name, self.help),
+            "# TYPE {} {}\n".format(self.name, self.kind),
+        ]
+        lines.extend(_format(*s) for s in self.samples())
+        return "".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+
+            counts[0][i] += 1
+            counts[1] += value
+
+    def samples(self):
+        with self.lock:
+            items = sorted((k, (list(c), s)) for k, (c, s) in self.values.items())
+
+        for key, (counts, total) in items:
+            labels = list(zip(self.labels, key))
+            n = 0
+            for le, c in zip(self.buckets + ("+Inf", ), counts):
+                n += c
+                yield self.name + "_bucket", labels + [("le", le)], n
+
+            yield self.name + "_sum", labels, total
+            yield self.name + "_count", labels, n
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return "".join(m.render() for m in self.metrics)
+
+
+REGISTRY = Registry()
+
+TASKS = REGISTRY.register(Gauge(
+    "mordred_web_tasks", "Number of queued tasks by state.", ["state"]))
+JOBS_IN_FLIGHT = REGISTRY.register(Gauge(
+    "mordred_web_jobs_in_flight", "Number of jobs submitted to the worker pool."))
+JOB_SECONDS = REGISTRY.register(Histogram(
+    "mordred_web_job_duration_seconds",
+    "Job latency from submission to result by phase.", ["phase"]))
+JOB_ERRORS = REGISTRY.register(Counter(
+    "mordred_web_job_errors_total", "Number of failed jobs by phase.", ["phase"]))
+MOLECULES = REGISTRY.register(Counter(
+    "mordred_web_molecules_total", "Number of processed molecules by phase.", ["phase"]))
+WORKER_RESTARTS = REGISTRY.register(Counter(
+    "mordred_web_worker_restarts_total", "Number of worker processes started after startup."))
+WORKER_RECYCLES = REGISTRY.register(Counter(
+    "mordred_web_worker_recycles_total",
+    "Number of worker processes retired after a job by reason.", ["reason"]))
+SQLITE_COMMIT_SECONDS = REGISTRY.register(Histogram(
+    "mordred_web_sqlite_commit_seconds", "SQLite transaction commit latency."))
+SSE_SUBSCRIBERS = REGISTRY.register(Gauge(
+    "mordred_web_sse_subscribers", "Number of connected event-stream clients."))
+RETENTION_DELETED = REGISTRY.register(Counter(
+    "mordred_web_retention_deleted_total", "Number of rows deleted by retention.", ["kind"]))
+RETENTION_RECLAIMED_BYTES = REGISTRY.register(Counter(
+    "mordred_web_retention_reclaimed_bytes_total",
+    "Bytes returned to the file system by incremental vacuum."))
+REMOTE_NODES = REGISTRY.register(Gauge(
+    "mordred_web_remote_nodes", "Number of connected remote worker nodes."))
+JOBS_REASSIGNED = REGISTRY.register(Counter(
+    "mordred_web_jobs_reassigned_total", "Number of jobs reassigned from lost remote nodes."))
+
+TASKS.set(0, state="pending")
+TASKS.set(0, state="working")
+JOBS_IN_FLIGHT.set(0)
+WORKER_RESTARTS.inc(0)
+WORKER_RECYCLES.inc(0, reason="jobs")
+WORKER_RECYCLES.inc(0, reason="memory")
+SSE_SUBSCRIBERS.set(0)
+REMOTE_NODES.set(0)
+JOBS_REASSIGNED.inc(0)
+RETENTION_RECLAIMED_BYTES.inc(0)
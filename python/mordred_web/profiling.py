@@ -0,0 +1,59 @@
+import time
+from collections import OrderedDict
+
+from .lazy import lazy_import
+
+mordred = lazy_import("mordred")
+
+
+class Profiled(object):
+    """Result of a profiled job with its worker-side timings."""
+
+    def __init__(self, value, started, ended, modules=None):
+        self.value = value
+        self.started = started
+        self.ended = ended
+        self.modules = modules or []
+
+
+def module_calculators(calc):
+    """Group descriptors of calc by mordred module.
+
+    Returns a list of (module name, Calculator, descriptor indices). Each
+    module computes its own intermediate results, so module times include
+    the dependencies they share with other modules.
+    """
+    modules = OrderedDict()
+    for i, desc in enumerate(calc.descriptors):
+        name = desc.__class__.__module__.split(".")[-1]
+        modules.setdefault(name, []).append(i)
+
+    return [(name, mordred.Calculator(calc.descriptors[i] for i in indices), indices)
+            for name, indices in modules.items()]
+
+
+def run_profiled(f, *args):
+    started = time.time()
+    value = f(*args)
+    return Profiled(value, started, time.time())
+
+
+def record_profile(cur, job, profiled, phase, file_id, calc_id=None, molecule_id=None,
+                   descriptors=None):
+    """Store timings of a profiled job.
+
+    Queue wait spans from submission to the start of the job in a worker, and
+    IPC from its end to the arrival of the result; both include pickling.
+    """
+    now = time.time()
+    cur.execute("""
+        INSERT INTO profile
+            (file_id, calc_id, molecule_id, phase, wall, queue_wait, ipc, descriptors)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (file_id, calc_id, molecule_id, phase, profiled.ended - profiled.started,
+              profiled.started - job.submitted_at, now - profiled.ended, descriptors))
+
+    profile_id = cur.lastrowid
+    cur.executemany(
+        "INSERT INTO profile_module (profile_id, module, wall) VALUES (?, ?, ?)",
+        [(profile_id, module, wall) for module, wall in profiled.modules], )
@@ -0,0 +1,467 @@
+"""Run jobs of the task queue on worker nodes connected over TCP.
+
+Messages are length-prefixed frames. The first frame of a connection is a
+JSON handshake carrying the shared token and the capacity of the node; the
+following frames are pickles, so only nodes knowing the token are trusted.
+A token is required, and the listener must stay on a trusted network: the
+token is sent in clear text.
+"""
+
+import hmac
+import json
+import time
+import socket
+import struct
+import pickle
+import argparse
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import Future, TimeoutError
+
+from loky import ProcessPoolExecutor
+
+from .metrics import REMOTE_NODES, JOBS_REASSIGNED
+from .warmup import warm_up
+from .task_queue import RecyclingExecutor
+
+HEADER = struct.Struct("!I")
+MAX_HANDSHAKE = 64 * 1024
+MEGA = 1024 * 1024
+
+
+def parse_address(address):
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def send_frame(sock, data):
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def recv_exact(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(min(n - len(buf), 1 << 20))
+        if not chunk:
+            raise EOFError("connection closed")
+        buf.extend(chunk)
+
+    return bytes(buf)
+
+
+def recv_frame(sock, limit=None):
+    n, = HEADER.unpack(recv_exact(sock, HEADER.size))
+    if limit is not None and n > limit:
+        raise ValueError("frame too large: {} bytes".format(n))
+
+    return recv_exact(sock, n)
+
+
+def send_message(sock, lock, *msg):
+    data = pickle.dumps(msg, pickle.HIGHEST_PROTOCOL)
+    with lock:
+        send_frame(sock, data)
+
+
+def recv_message(sock):
+    return pickle.loads(recv_frame(sock))
+
+
+class Node(object):
+    def __init__(self, sock, address, capacity):
+        self.sock = sock
+        self.address = address
+        self.capacity = capacity
+        self.inflight = {}
+        self.last_seen = time.time()
+        self.lock = threading.Lock()
+
+    def send(self, *msg):
+        send_message(self.sock, self.lock, *msg)
+
+
+class RemoteExecutor(object):
+    """Executor running jobs on worker nodes connected to address.
+
+    Jobs wait until a node has a free slot. Jobs of a node that disconnects
+    or misses heartbeats for timeout seconds are reassigned to other nodes.
+    The timeout of a job starts when it is sent to a node, not while it waits
+    for one; on expiry the node is told to cancel it.
+    """
+
+    runs_timeouts = True
+
+    def __init__(self, address, token, heartbeat=5.0, timeout=20.0):
+        if not token:
+            raise ValueError("remote workers require a non-empty token")
+
+        self.token = token
+        self.heartbeat = heartbeat
+        self.timeout = timeout
+        self._ids = itertools.count()
+        self._pending = deque()
+        self._nodes = set()
+        self._cond = threading.Condition()
+        self._closed = False
+
+        self._listener = socket.create_server(parse_address(address))
+        self.address = self._listener.getsockname()
+
+        for target in [self._accept, self._dispatch, self._reap, self._expire]:
+            threading.Thread(target=target, daemon=True).start()
+
+    def submit(self, job, timeout=None):
+        fut = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("cannot submit after shutdown")
+
+            self._pending.append((next(self._ids), job, fut, timeout))
+            self._cond.notify_all()
+
+        return fut
+
+    def capacity(self):
+        """Return the number of jobs the connected nodes run at once."""
+        with self._cond:
+            return sum(node.capacity for node in self._nodes)
+
+    def shutdown(self, wait=True):
+        with self._cond:
+            self._closed = True
+            nodes = list(self._nodes)
+            pending = list(self._pending)
+            self._pending.clear()
+            self._cond.notify_all()
+
+        self._listener.close()
+        for node in nodes:
+            try:
+                node.send("bye")
+            except OSError:
+                pass
+            self._drop(node)
+
+        for _, _, fut, _ in pending:
+            self._abort(fut)
+
+    def _abort(self, fut):
+        if not fut.cancel() and not fut.done():
+            fut.set_exception(RuntimeError("executor was shut down"))
+
+    def _accept(self):
+        while True:
+            try:
+                sock, address = self._listener.accept()
+            except OSError:
+                return
+
+            threading.Thread(target=self._serve, args=(sock, address), daemon=True).start()
+
+    def _handshake(self, sock):
+        sock.settimeout(self.timeout)
+        hello = json.loads(recv_frame(sock, MAX_HANDSHAKE).decode("UTF-8"))
+        ok = hmac.compare_digest(str(hello.get("token", "")), self.token)
+        send_frame(sock, json.dumps({"ok": ok}).encode("UTF-8"))
+        if not ok:
+            raise ValueError("invalid token")
+
+        sock.settimeout(None)
+        return max(1, int(hello.get("capacity", 1)))
+
+    def _serve(self, sock, address):
+        try:
+            capacity = self._handshake(sock)
+        except Exception:
+            sock.close()
+            return
+
+        node = Node(sock, address, capacity)
+        with self._cond:
+            if self._closed:
+                sock.close()
+                return
+
+            self._nodes.add(node)
+            REMOTE_NODES.set(len(self._nodes))
+            self._cond.notify_all()
+
+        try:
+            while True:
+                msg = recv_message(sock)
+                node.last_seen = time.time()
+                if msg[0] == "result":
+                    self._on_result(node, *msg[1:])
+        except Exception:
+            pass
+        finally:
+            self._drop(node)
+
+    def _on_result(self, node, job_id, ok, value):
+        with self._cond:
+            entry = node.inflight.pop(job_id, None)
+            self._cond.notify_all()
+
+            # expired jobs keep their slot until the node answers
+            if entry is None or entry[1].done():
+                return
+
+            fut = entry[1]
+            if ok:
+                fut.set_result(value)
+            else:
+                fut.set_exception(value)
+
+    def _drop(self, node):
+        with self._cond:
+            if node not in self._nodes:
+                return
+
+            self._nodes.discard(node)
+            REMOTE_NODES.set(len(self._nodes))
+            inflight = sorted(node.inflight.items())
+            node.inflight = {}
+            if not self._closed:
+                for job_id, (job, fut, timeout, _) in reversed(inflight):
+                    if not fut.done():
+                        self._pending.appendleft((job_id, job, fut, timeout))
+
+                JOBS_REASSIGNED.inc(len(inflight))
+            self._cond.notify_all()
+
+        if self._closed:
+            for _, (_, fut, _, _) in inflight:
+                self._abort(fut)
+
+        try:
+            node.sock.close()
+        except OSError:
+            pass
+
+    def _next_assignment(self):
+        with self._cond:
+            while True:
+                if self._closed:
+                    return None
+
+                free = [n for n in self._nodes if len(n.inflight) < n.capacity]
+                if self._pending and free:
+                    node = min(free, key=lambda n: len(n.inflight) / n.capacity)
+                    job_id, job, fut, timeout = self._pending.popleft()
+                    # reassigned jobs are already running
+                    if not fut.running() and not fut.set_running_or_notify_cancel():
+                        continue
+
+                    deadline = None if timeout is None else time.time() + timeout
+                    node.inflight[job_id] = job, fut, timeout, deadline
+                    self._cond.notify_all()
+                    return node, job_id, job, fut
+
+                self._cond.wait()
+
+    def _dispatch(self):
+        while True:
+            assignment = self._next_assignment()
+            if assignment is None:
+                return
+
+            node, job_id, job, fut = assignment
+            try:
+                data = pickle.dumps(("job", job_id, job), pickle.HIGHEST_PROTOCOL)
+            except Exception as e:
+                with self._cond:
+                    node.inflight.pop(job_id, None)
+                    self._cond.notify_all()
+
+                fut.set_exception(e)
+                continue
+
+            try:
+                with node.lock:
+                    send_frame(node.sock, data)
+            except OSError:
+                self._drop(node)
+
+    def _reap(self):
+        while not self._closed:
+            time.sleep(self.heartbeat)
+            with self._cond:
+                nodes = list(self._nodes)
+
+            now = time.time()
+            for node in nodes:
+                if now - node.last_seen > self.timeout:
+                    self._drop(node)
+                    continue
+
+                try:
+                    node.send("heartbeat")
+                except OSError:
+                    self._drop(node)
+
+    def _expire(self):
+        """Fail jobs running past their timeout and cancel them on their node."""
+        while True:
+            expired = []
+            with self._cond:
+                if self._closed:
+                    return
+
+                now = time.time()
+                deadlines = []
+                for node in self._nodes:
+                    for job_id, (_, fut, _, deadline) in node.inflight.items():
+                        if deadline is None or fut.done():
+                            continue
+
+                        if deadline <= now:
+                            fut.set_exception(TimeoutError())
+                            expired.append((node, job_id))
+                        else:
+                            deadlines.append(deadline)
+
+                if not expired:
+                    self._cond.wait(min(deadlines) - now if deadlines else None)
+
+            for node, job_id in expired:
+                try:
+                    node.send("cancel", job_id)
+                except OSError:
+                    self._drop(node)
+
+
+class Worker(object):
+    """Worker node running jobs of a server on a local process pool."""
+
+    def __init__(self, address, token, workers=1, heartbeat=5.0, timeout=20.0,
+                 max_jobs=None, max_memory=None, initializer=None):
+        self.address = parse_address(address)
+        self.token = token
+        self.workers = workers
+        self.heartbeat = heartbeat
+        self.timeout = timeout
+        if max_jobs is None and max_memory is None:
+            self.pool = ProcessPoolExecutor(workers, initializer=initializer)
+        else:
+            self.pool = RecyclingExecutor(
+                workers, max_jobs=max_jobs, max_memory=max_memory, initializer=initializer)
+
+    def connect(self):
+        sock = socket.create_connection(self.address)
+        send_frame(sock, json.dumps({
+            "capacity": self.workers,
+            "token": self.token,
+        }).encode("UTF-8"))
+
+        sock.settimeout(self.timeout)
+        if not json.loads(recv_frame(sock, MAX_HANDSHAKE).decode("UTF-8")).get("ok"):
+            sock.close()
+            raise PermissionError("server rejected the token")
+
+        return sock
+
+    def run(self):
+        """Serve jobs, reconnecting after the connection is lost."""
+        while True:
+            try:
+                sock = self.connect()
+            except PermissionError:
+                raise
+            except OSError:
+                time.sleep(1)
+                continue
+
+            print("connected to {}:{}".format(*self.address))  # noqa: T003
+            if self.serve(sock):
+                return
+
+    def serve(self, sock):
+        lock = threading.Lock()
+        futures = {}
+        connected = threading.Event()
+        connected.set()
+
+        def beat():
+            while connected.is_set():
+                try:
+                    send_message(sock, lock, "heartbeat")
+                except OSError:
+                    return
+                time.sleep(self.heartbeat)
+
+        def done(job_id, fut):
+            with lock:
+                futures.pop(job_id, None)
+
+            try:
+                msg = "result", job_id, True, fut.result()
+            except Exception as e:
+                msg = "result", job_id, False, e
+
+            try:
+                try:
+                    send_message(sock, lock, *msg)
+                except (pickle.PicklingError, TypeError, AttributeError) as e:
+                    send_message(sock, lock, "result", job_id, False, RuntimeError(repr(e)))
+            except OSError:
+                pass
+
+        threading.Thread(target=beat, daemon=True).start()
+        try:
+            while True:
+                msg = recv_message(sock)
+                if msg[0] == "job":
+                    _, job_id, job = msg
+                    fut = self.pool.submit(job)
+                    with lock:
+                        futures[job_id] = fut
+
+                    fut.add_done_callback(lambda fut, job_id=job_id: done(job_id, fut))
+                elif msg[0] == "cancel":
+                    # a running job can't be stopped, and finishes unused
+                    with lock:
+                        fut = futures.get(msg[1])
+
+                    if fut is not None:
+                        fut.cancel()
+                elif msg[0] == "bye":
+                    return True
+        except (OSError, EOFError):
+            return False
+        finally:
+            connected.clear()
+            sock.close()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog="mordred_web worker", description="Mordred Web remote worker")
+    parser.add_argument("address", metavar="HOST:PORT", help="server address")
+    parser.add_argument(
+        "-w", "--workers", type=int, default=1, help="number of worker processes")
+    parser.add_argument(
+        "--token", type=str, required=True, help="token shared with the server")
+    parser.add_argument(
+        "--max-jobs-per-worker", metavar="N", type=int, default=None,
+        help="replace a worker process after it has run N jobs")
+    parser.add_argument(
+        "--worker-memory-limit", metavar="MB", type=int, default=None,
+        help="replace a worker process when its resident memory exceeds MB after a job")
+    parser.add_argument(
+        "--no-warmup", dest="warmup", action="store_false",
+        help="don't warm up worker processes before they take jobs")
+    args = parser.parse_args(args)
+
+    worker = Worker(
+        args.address, token=args.token, workers=args.workers, max_jobs=args.max_jobs_per_worker,
+        max_memory=None if args.worker_memory_limit is None else args.worker_memory_limit * MEGA,
+        initializer=warm_up if args.warmup else None)
+    try:
+        worker.run()
+    except PermissionError as e:
+        parser.exit(1, "{}\n".format(e))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        worker.pool.shutdown()
@@ -0,0 +1,184 @@
+import time
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from .db import Phase, transaction
+from .metrics import RETENTION_DELETED, RETENTION_RECLAIMED_BYTES
+
+INCREMENTAL = 2  # PRAGMA auto_vacuum
+
+
+class Retention(object):
+    """Delete expired files with their calcs, and return free pages to the OS.
+
+    Files older than ttl seconds are deleted, and then the oldest files while
+    the database is larger than max_size bytes. Rows are deleted a few files at
+    a time through ON DELETE CASCADE, and only while the task queue is idle.
+
+    Deletes and vacuums run on a thread with a connection of its own, so that
+    cascades through large tables don't block the IOLoop; conn is used for
+    stats only. The database is switched to WAL, so that the IOLoop reads
+    while the thread writes.
+    """
+
+    BATCH = 10
+    CHUNK = 5000
+    VACUUM_PAGES = 1000
+
+    def __init__(self, db, conn, queue, export_cache, ttl=None, max_size=None):
+        self.db = db
+        self.conn = conn
+        self.executor = ThreadPoolExecutor(1)
+        self.worker_conn = None
+        self.queue = queue
+        self.export_cache = export_cache
+        self.ttl = ttl
+        self.max_size = max_size
+        self.running = False
+        self.deleted_files = 0
+        self.deleted_calcs = 0
+        self.reclaimed = 0
+        self.last_run = None
+
+    def connection(self):
+        """Return the connection of the retention thread."""
+        if self.worker_conn is None:
+            self.worker_conn = sqlite3.connect(self.db, isolation_level="DEFERRED")
+            self.worker_conn.execute("PRAGMA foreign_keys = ON")
+
+        return self.worker_conn
+
+    @staticmethod
+    def pragma(conn, name):
+        return conn.execute("PRAGMA {}".format(name)).fetchone()[0]
+
+    def size(self, conn):
+        """Return used and free bytes of the database file."""
+        page_size = self.pragma(conn, "page_size")
+        free = self.pragma(conn, "freelist_count")
+        return (self.pragma(conn, "page_count") - free) * page_size, free * page_size
+
+    def expired(self, conn, cur):
+        finished = (Phase.DONE.value, Phase.ERROR.value)
+
+        if self.ttl is not None:
+            cur.execute(
+                "SELECT id FROM file WHERE created_at < ? AND phase IN (?, ?) "
+                "ORDER BY created_at LIMIT ?",
+                (time.time() - self.ttl, ) + finished + (self.BATCH, ), )
+            ids = [i for i, in cur.fetchall()]
+            if ids:
+                return ids
+
+        if self.max_size is not None and self.size(conn)[0] > self.max_size:
+            cur.execute(
+                "SELECT id FROM file WHERE phase IN (?, ?) ORDER BY created_at LIMIT ?",
+                finished + (self.BATCH, ), )
+            return [i for i, in cur.fetchall()]
+
+        return []
+
+    def delete_rows(self, conn, table, column, value):
+        """Delete the rows of table where column is value, CHUNK rows per transaction."""
+        while True:
+            with transaction(conn) as cur:
+                cur.execute(
+                    "DELETE FROM {0} WHERE rowid IN (SELECT rowid FROM {0} WHERE {1} = ? LIMIT ?)"
+                    .format(table, column), (value, self.CHUNK))
+                if cur.rowcount < self.CHUNK:
+                    return
+
+    def delete_batch(self):
+        """Delete a batch of expired files on the retention thread.
+
+        Results and molecules, the bulk of the rows, are deleted a chunk at a
+        time first, so that no transaction keeps the IOLoop from writing for
+        long. Returns the text ids of their calcs, or None if no file has
+        expired.
+        """
+        conn = self.connection()
+        with transaction(conn) as cur:
+            file_ids = self.expired(conn, cur)
+            if not file_ids:
+                return None
+
+            marks = ",".join("?" * len(file_ids))
+            cur.execute(
+                "SELECT id, text_id FROM calc WHERE file_id IN ({})".format(marks), file_ids)
+            calcs = cur.fetchall()
+
+        for calc_id, _ in calcs:
+            self.delete_rows(conn, "result", "calc_id", calc_id)
+
+        for file_id in file_ids:
+            self.delete_rows(conn, "molecule", "file_id", file_id)
+
+        with transaction(conn) as cur:
+            cur.execute("DELETE FROM file WHERE id IN ({})".format(marks), file_ids)
+
+        self.deleted_files += len(file_ids)
+        self.deleted_calcs += len(calcs)
+        RETENTION_DELETED.inc(len(file_ids), kind="file")
+        RETENTION_DELETED.inc(len(calcs), kind="calc")
+        return [text_id for _, text_id in calcs]
+
+    def vacuum(self):
+        """Release up to VACUUM_PAGES free pages, returning the released bytes.
+
+        Runs on the retention thread.
+        """
+        conn = self.connection()
+        if self.pragma(conn, "auto_vacuum") != INCREMENTAL:
+            return 0
+
+        if self.pragma(conn, "freelist_count") == 0:
+            return 0
+
+        before = self.pragma(conn, "page_count")
+        conn.execute("PRAGMA incremental_vacuum({:d})".format(self.VACUUM_PAGES)).fetchall()
+        reclaimed = (before - self.pragma(conn, "page_count")) * self.pragma(conn, "page_size")
+
+        self.reclaimed += reclaimed
+        RETENTION_RECLAIMED_BYTES.inc(reclaimed)
+        return reclaimed
+
+    @gen.coroutine
+    def run(self):
+        if self.running or not self.queue.idle():
+            return
+
+        ioloop = IOLoop.current()
+        self.running = True
+        try:
+            while self.queue.idle():
+                calcs = yield ioloop.run_in_executor(self.executor, self.delete_batch)
+                if calcs is None:
+                    break
+
+                for text_id in calcs:
+                    self.export_cache.remove(text_id)
+
+            while self.queue.idle():
+                reclaimed = yield ioloop.run_in_executor(self.executor, self.vacuum)
+                if reclaimed == 0:
+                    break
+        finally:
+            self.running = False
+            self.last_run = time.time()
+
+    def stats(self):
+        used, free = self.size(self.conn)
+        return {
+            "deleted_calcs": self.deleted_calcs,
+            "deleted_files": self.deleted_files,
+            "free_bytes": free,
+            "incremental_vacuum": self.pragma(self.conn, "auto_vacuum") == INCREMENTAL,
+            "last_run": self.last_run,
+            "max_size": self.max_size,
+            "reclaimed_bytes": self.reclaimed,
+            "ttl": self.ttl,
+            "used_bytes": used,
+        }
@@ -0,0 +1,102 @@
+"""Longest processing time first (LPT) ordering of molecule jobs.
+
+In file order a few large molecules at the end of a file run alone on one
+worker while the others idle; started first, they are overlapped by the
+small ones instead.
+"""
+
+import time
+import sqlite3
+import threading
+from contextlib import closing
+
+import numpy as np
+from rdkit.Chem import rdMolDescriptors
+
+from .db import transaction, database_file
+
+SCHEDULES = ("file", "lpt")
+
+# seconds of a job by features (1, heavy atoms, heavy atoms squared, rings,
+# rotatable bonds), fitted to the example files with all descriptors
+DEFAULT_WEIGHTS = {
+    "calc": (0.05, 0.0, 0.0002, 0.05, 0.01),
+    "prepare_3D": (0.005, 0.002, 0.0007, 0.0, 0.0),
+}
+
+# profiled jobs of a phase, with seconds per descriptor for calc
+SAMPLES = {
+    "calc": """
+        SELECT molecule.mol, profile.wall / profile.descriptors
+        FROM profile JOIN molecule ON molecule.id = profile.molecule_id
+        WHERE profile.phase = 'calc' AND profile.descriptors > 0
+        ORDER BY profile.id DESC
+        LIMIT ?
+    """,
+    "prepare_3D": """
+        SELECT molecule.mol, profile.wall
+        FROM profile
+            JOIN molecule ON molecule.id = profile.molecule_id
+            JOIN file ON file.id = profile.file_id
+        WHERE profile.phase = 'prepare' AND file.gen3D = 1
+        ORDER BY profile.id DESC
+        LIMIT ?
+    """,
+}
+
+
+def features(mol):
+    heavy = mol.GetNumHeavyAtoms()
+    return (1.0, heavy, heavy * heavy, rdMolDescriptors.CalcNumRings(mol),
+            rdMolDescriptors.CalcNumRotatableBonds(mol))
+
+
+class CostModel(object):
+    """Estimated cost of a job on a molecule, by phase.
+
+    Starts from DEFAULT_WEIGHTS, and is refit by least squares to the latest
+    profiled jobs (?profile=true) once there are MIN_SAMPLES of a phase.
+    Only the order of the costs of a task matters.
+
+    Tasks order their jobs on worker threads, so samples are read through a
+    connection of the fit's own.
+    """
+
+    MIN_SAMPLES = 50
+    MAX_SAMPLES = 2000
+    REFIT = 600
+
+    def __init__(self, conn):
+        self.db_file = database_file(conn)
+        self.weights = dict(DEFAULT_WEIGHTS)
+        self.fitted_at = {}
+        self.lock = threading.Lock()
+
+    def fit(self, phase):
+        with self.lock:
+            now = time.time()
+            if now - self.fitted_at.get(phase, 0) < self.REFIT:
+                return
+
+            self.fitted_at[phase] = now
+
+        with closing(sqlite3.connect(self.db_file)) as conn:
+            with transaction(conn) as cur:
+                cur.execute(SAMPLES[phase], (self.MAX_SAMPLES, ))
+                rows = cur.fetchall()
+
+        if len(rows) < self.MIN_SAMPLES:
+            return
+
+        X = np.array([features(mol) for mol, _ in rows])
+        y = np.array([wall for _, wall in rows])
+        weights, _, _, _ = np.linalg.lstsq(X, y, rcond=None)
+        self.weights[phase] = tuple(np.clip(weights, 0, None))
+
+    def cost(self, mol, phase):
+        return float(np.dot(self.weights[phase], features(mol)))
+
+    def order(self, items, phase, mol=lambda item: item[0]):
+        """Return items sorted by descending cost of mol(item)."""
+        self.fit(phase)
+        return sorted(items, key=lambda item: self.cost(mol(item), phase), reverse=True)
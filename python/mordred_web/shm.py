@@ -0,0 +1,100 @@
+"""Molecule batches exchanged with local workers through shared memory.
+
+A batch is one segment holding a float64 value matrix, an int32 code matrix
+and the RDKit binaries of its molecules; only the segment name and offsets
+are pickled. Codes tell integer values from floats, and errors apart by the
+index of their message.
+"""
+
+from multiprocessing import shared_memory
+
+import numpy as np
+
+FLOAT = 0
+INT = 1
+ERROR = 2  # ERROR + i is the i-th error message of the batch
+
+
+class SharedBatch(object):
+    def __init__(self, name, offsets, descriptors):
+        self.name = name
+        self.offsets = offsets
+        self.descriptors = descriptors
+        self.shm = None
+        self.values = None
+        self.codes = None
+
+    @classmethod
+    def create(cls, mols, descriptors):
+        """Create a segment holding mols, owned by this process until unlink()."""
+        binaries = [mol.ToBinary() for mol in mols]
+        offsets = [len(binaries) * descriptors * 12]
+        for b in binaries:
+            offsets.append(offsets[-1] + len(b))
+
+        shm = shared_memory.SharedMemory(create=True, size=max(offsets[-1], 1))
+        for b, offset in zip(binaries, offsets):
+            shm.buf[offset:offset + len(b)] = b
+
+        batch = cls(shm.name, offsets, descriptors)
+        batch.map(shm)
+        return batch
+
+    def __getstate__(self):
+        return self.name, self.offsets, self.descriptors
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def map(self, shm):
+        self.shm = shm
+        shape = (len(self), self.descriptors)
+        self.values = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+        self.codes = np.ndarray(shape, dtype=np.int32, buffer=shm.buf, offset=self.values.nbytes)
+
+    def attach(self):
+        # loky workers share the resource tracker of the server, which already
+        # tracks the segment, so registering it again here is harmless
+        self.map(shared_memory.SharedMemory(self.name))
+
+    def close(self):
+        self.values = self.codes = None
+        self.shm.close()
+
+    def unlink(self):
+        shm = self.shm
+        self.close()
+        shm.unlink()
+
+    def mol(self, i):
+        """Return the binary of the i-th molecule."""
+        return bytes(self.shm.buf[self.offsets[i]:self.offsets[i + 1]])
+
+    def write(self, row, results, messages):
+        """Store (value, error) results of a molecule.
+
+        New error messages are numbered in the messages dict.
+        """
+        for col, (value, error) in enumerate(results):
+            if error is not None:
+                self.codes[row, col] = ERROR + messages.setdefault(error, len(messages))
+            else:
+                self.values[row, col] = value
+                self.codes[row, col] = INT if isinstance(value, (int, np.integer)) else FLOAT
+
+    def read(self, messages):
+        """Yield (row, col, value, error) of stored results.
+
+        messages is the list of error messages, ordered by number.
+        """
+        for row, (values, codes) in enumerate(zip(self.values.tolist(), self.codes.tolist())):
+            for col, (value, code) in enumerate(zip(values, codes)):
+                if code == FLOAT:
+                    yield row, col, value, None
+                elif code == INT:
+                    yield row, col, int(value), None
+                else:
+                    yield row, col, None, messages[code - ERROR]
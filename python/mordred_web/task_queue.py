@@ -1,10 +1,20 @@
+import os
+import time
+import socket
 import threading
 from abc import ABCMeta, abstractmethod
+from collections import deque
+from concurrent.futures import Future, TimeoutError
 
+import psutil
 from six import with_metaclass
 from loky import ProcessPoolExecutor
+from tornado.ioloop import IOLoop
+from loky.process_executor import BrokenProcessPool
 
 from . import exitable
+from .metrics import (TASKS, JOB_ERRORS, JOB_SECONDS, JOBS_IN_FLIGHT, WORKER_RECYCLES,
+                      WORKER_RESTARTS)
 
 
 class Task(with_metaclass(ABCMeta, object)):
@@ -31,6 +41,7 @@ class Task(with_metaclass(ABCMeta, object)):
         return None
 
     timeout = None
+    phase = None
 
 
 class SingleTask(Task):
@@ -49,6 +60,7 @@ class SingleTask(Task):
 class TaskWrapper(object):
     def __init__(self, task):
         self.raw = task
+        self.phase = task.phase or type(task).__name__
         self.job_count = 0
         self.lock = threading.Lock()
 
@@ -108,6 +120,8 @@ class MoveThread(Daemon):
     def _main(self):
         self.q._sem.acquire()
         task = self.q._pendings.get()
+        TASKS.dec(state="pending")
+        TASKS.inc(state="working")
         self.q._workings.put(task)
 
         self.q._ioloop.add_callback(task.raw.on_task_start)
@@ -119,6 +133,7 @@ class OnTaskEnd(object):
         self.task = task
 
     def task_end_callback(self):
+        TASKS.dec(state="working")
         self.task.raw.on_task_end()
 
         next_task = self.task.raw.next_task()
@@ -150,35 +165,215 @@ class WorkerThread(Daemon):
 
         task.incr()
         self.q._workings.put(task)
-        fut = self.q._pool.submit(job)
+        start = time.time()
+        # a job may carry its own timeout, e.g. a batch of molecules
+        timeout = getattr(job, "timeout", task.raw.timeout)
+        if getattr(self.q._pool, "runs_timeouts", False):
+            # counted from when a node picks the job up, not while it waits for one
+            fut, timeout = self.q._pool.submit(job, timeout=timeout), None
+        else:
+            fut = self.q._pool.submit(job)
+
+        JOBS_IN_FLIGHT.inc()
         self.q._ioloop.add_callback(task.raw.on_job_start, job)
 
         try:
-            result = fut.result(timeout=task.raw.timeout)
+            result = fut.result(timeout=timeout)
             self.q._ioloop.add_callback(task.raw.on_job_end, job, result)
         except Exception as e:
+            if isinstance(e, TimeoutError):
+                fut.cancel()
+
+            JOB_ERRORS.inc(phase=task.phase)
             self.q._ioloop.add_callback(task.raw.on_job_error, job, e)
+        finally:
+            JOBS_IN_FLIGHT.dec()
+            JOB_SECONDS.observe(time.time() - start, phase=task.phase)
+            self.q.check_workers()
 
         task.decr(self.task_end(task))
 
 
+class Ping(object):
+    """Return the host and pid of the worker running it."""
+
+    def __call__(self):
+        return socket.gethostname(), os.getpid()
+
+
+class Measured(object):
+    """Run job, returning its result with the RSS of the worker afterwards."""
+
+    def __init__(self, job):
+        self.job = job
+
+    def __call__(self):
+        return self.job(), psutil.Process().memory_info().rss
+
+
+class Slot(object):
+    def __init__(self, initializer=None):
+        self.pool = ProcessPoolExecutor(1, initializer=initializer)
+        self.jobs = 0
+        # starts the worker and its initializer, outside of the job count
+        self.warm = self.pool.submit(Ping())
+
+
+class RecyclingExecutor(object):
+    """Process pool recycling workers by job count and memory.
+
+    A worker is replaced once it has run max_jobs jobs, or its RSS after a
+    job exceeds max_memory bytes. Each worker is a single-process pool, so
+    a worker is retired between jobs without disturbing the others.
+    """
+
+    def __init__(self, workers, max_jobs=None, max_memory=None, initializer=None):
+        self.max_jobs = max_jobs
+        self.max_memory = max_memory
+        self.initializer = initializer
+        self._lock = threading.Lock()
+        self._pending = deque()
+        self._idle = [Slot(initializer) for _ in range(workers)]
+        self._busy = set()
+        self._closed = False
+
+    def submit(self, job):
+        fut = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("cannot submit after shutdown")
+
+            self._pending.append((job, fut))
+
+        self._dispatch()
+        return fut
+
+    def _dispatch(self):
+        assignments = []
+        with self._lock:
+            while self._pending and self._idle:
+                job, fut = self._pending.popleft()
+                if fut.set_running_or_notify_cancel():
+                    slot = self._idle.pop()
+                    self._busy.add(slot)
+                    assignments.append((slot, job, fut))
+
+        for slot, job, fut in assignments:
+            slot.pool.submit(Measured(job)).add_done_callback(
+                lambda inner, slot=slot, fut=fut: self._done(slot, fut, inner))
+
+    def retire_reason(self, slot, rss):
+        if self.max_jobs is not None and slot.jobs >= self.max_jobs:
+            return "jobs"
+
+        if self.max_memory is not None and rss is not None and rss > self.max_memory:
+            return "memory"
+
+        return None
+
+    def _done(self, slot, fut, inner):
+        slot.jobs += 1
+        rss = None
+        try:
+            value, rss = inner.result()
+        except BrokenProcessPool as e:
+            fut.set_exception(e)
+            replace = True
+        except Exception as e:
+            fut.set_exception(e)
+            replace = False
+        else:
+            fut.set_result(value)
+            replace = False
+
+        reason = None if replace else self.retire_reason(slot, rss)
+        if reason is not None:
+            WORKER_RECYCLES.inc(reason=reason)
+            replace = True
+
+        with self._lock:
+            self._busy.discard(slot)
+            if self._closed:
+                slot.pool.shutdown(wait=False)
+                return
+
+            if replace:
+                slot.pool.shutdown(wait=False)
+                slot = Slot(self.initializer)
+                WORKER_RESTARTS.inc()
+
+            self._idle.append(slot)
+
+        self._dispatch()
+
+    def warm(self):
+        """Return futures answered once each current worker has been initialized."""
+        with self._lock:
+            return [slot.warm for slot in self._idle + list(self._busy)]
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            self._closed = True
+            pending = list(self._pending)
+            self._pending.clear()
+            slots = self._idle + list(self._busy)
+
+        for _, fut in pending:
+            fut.cancel()
+
+        for slot in slots:
+            slot.pool.shutdown(wait=wait)
+
+
 class TaskQueue(object):
-    def __init__(self, workers, ioloop):
+    def __init__(self, workers, ioloop, executor=None, initializer=None):
         self._exit = threading.Event()
         self._pendings = exitable.ExitableQueue(self._exit)
         self._workings = exitable.ExitableQueue(self._exit, workers)
         self._sem = exitable.ExitableBoundedSemaphore(self._exit, workers)
-        self._pool = ProcessPoolExecutor(workers)
+        if executor is None:
+            executor = ProcessPoolExecutor(workers, initializer=initializer)
+
+        self._pool = executor
         self._cnt = Counter(0)
         self._ioloop = ioloop
+        self._max_workers = workers
+        self._worker_pids = set()
+        self._worker_lock = threading.Lock()
+        self.ready = False
 
         self._workers = [MoveThread(self)]
         self._workers += [WorkerThread(self) for _ in range(workers)]
 
     def put(self, task):
         self._cnt.incr()
+        TASKS.inc(state="pending")
         self._pendings.put(TaskWrapper(task))
 
+    def idle(self):
+        return self._cnt.value <= 0
+
+    def check_workers(self):
+        """Count worker processes started in place of exited ones."""
+        pids = set(getattr(self._pool, "_processes", None) or ())
+        with self._worker_lock:
+            new = pids - self._worker_pids
+            if not new:
+                return
+
+            spawned = len(self._worker_pids) + len(new) - self._max_workers
+            self._worker_pids |= new
+
+        WORKER_RESTARTS.inc(min(len(new), max(0, spawned)))
+
+    @property
+    def executor(self):
+        return self._pool
+
+    def submit(self, job):
+        """Run a single job on the worker pool, outside of task scheduling."""
+        return self._pool.submit(job)
+
     def __enter__(self):
         for w in self._workers:
             w.start()
@@ -187,6 +382,10 @@ class TaskQueue(object):
 
     def __exit__(self, *args, **kwargs):
         self._exit.set()
+        if getattr(self._pool, "runs_timeouts", False):
+            # jobs waiting for a node have no timeout yet; fail them to stop the workers
+            self._pool.shutdown()
+
         for w in self._workers:
             w.join()
 
@@ -235,11 +434,13 @@ class TestTask(Task):
 
 
 def main():
-    with TaskQueue(20) as q:
-        for i in range(100):
+    ioloop = IOLoop.current()
+    with TaskQueue(4, ioloop) as q:
+        for i in range(20):
             q.put(TestTask(i))
 
-        q.join()
+        # task callbacks run on the IOLoop, so join in another thread
+        ioloop.run_sync(lambda: ioloop.run_in_executor(None, q.join))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,50 @@
+"""Warm up worker processes before they take jobs.
+
+Importing mordred and RDKit and building the first calculator takes seconds,
+which would otherwise be paid by the first job of every new worker.
+"""
+
+from rdkit import Chem
+from tornado import gen
+
+from .task_queue import Ping
+from .handler.calc import PrepareWorker
+from .handler.file import gen3D
+
+WARMUP_SMILES = "c1ccccc1CC(=O)O"
+
+
+def warm_up():
+    """Pool initializer calculating all descriptors of a small molecule."""
+    calc, _ = PrepareWorker(set())()
+    _, mol = gen3D(Chem.MolFromSmiles(WARMUP_SMILES))
+    calc(mol)
+
+
+@gen.coroutine
+def wait_ready(queue, workers, interval=0.1, remote_interval=1.0):
+    """Set queue.ready once the workers are warm.
+
+    A worker takes jobs only after its initializer has finished, so pings are
+    answered by warm workers only. Workers of a RecyclingExecutor are pinged
+    by the executor itself, outside of their job count. Remote nodes warm up
+    their own workers, and the queue is ready while any node is connected.
+    """
+    executor = queue.executor
+    if hasattr(executor, "capacity"):
+        while True:
+            queue.ready = executor.capacity() > 0
+            yield gen.sleep(remote_interval)
+
+    if hasattr(executor, "warm"):
+        yield executor.warm()
+        queue.ready = True
+        return
+
+    seen = set()
+    while len(seen) < workers:
+        seen.update((yield [queue.submit(Ping()) for _ in range(workers)]))
+        if len(seen) < workers:
+            yield gen.sleep(interval)
+
+    queue.ready = True
@@ -38,4 +38,9 @@ setup(
         'openpyxl>=2.4',
     ],
 
+    extras_require={
+        'arrow': ['pyarrow>=0.15'],
+        'zstd': ['zstandard'],
+    },
+
 )
@@ -85,7 +85,7 @@ export interface FileInfoResult {
     is3D: boolean;
     desalt: boolean;
     phase: Phase;
-    mols: Array<{ name: string; forcefield: string }>;
+    mols: Array<{ name: string; forcefield: string; nth: number }>;
     errors: string[];
 }
 
@@ -94,9 +94,59 @@ export async function getFileInfo(id: string): promise.Promise<FileInfoResult> {
     return r.data;
 }
 
-export async function getPNG(id: string, nth: number): promise.Promise<Blob> {
-    const { data } = await axios.get(`/api/file/${id}/${nth}.png`, { responseType: "blob" });
-    return data;
+// defaults of the grid endpoint, whose first page is rendered in advance
+export const GRID_COUNT = 50;
+export const GRID_COLS = 10;
+export const GRID_SIZE = 200;
+
+export interface GridCell {
+    nth: number;
+    image: Blob | null;
+}
+
+function loadImage(blob: Blob): promise.Promise<HTMLImageElement> {
+    return new promise.Promise<HTMLImageElement>((resolve, reject) => {
+        const url = window.URL.createObjectURL(blob);
+        const img = new Image();
+        img.onload = () => {
+            window.URL.revokeObjectURL(url);
+            resolve(img);
+        };
+        img.onerror = reject;
+        img.src = url;
+    });
+}
+
+function cropCell(img: HTMLImageElement, i: number): promise.Promise<Blob | null> {
+    const canvas = document.createElement("canvas");
+    canvas.width = GRID_SIZE;
+    canvas.height = GRID_SIZE;
+    const x = (i % GRID_COLS) * GRID_SIZE;
+    const y = Math.floor(i / GRID_COLS) * GRID_SIZE;
+    const ctx = canvas.getContext("2d");
+    if (ctx === null) {
+        return promise.Promise.resolve(null);
+    }
+
+    ctx.drawImage(img, x, y, GRID_SIZE, GRID_SIZE, 0, 0, GRID_SIZE, GRID_SIZE);
+    return new promise.Promise<Blob | null>(resolve => canvas.toBlob(resolve, "image/png"));
+}
+
+// images of the molecules whose nth is in [start, start + GRID_COUNT), from one request
+export async function getGrid(id: string, start: number): promise.Promise<GridCell[]> {
+    const r = await axios.get(`/api/file/${id}/${start}-${start + GRID_COUNT}.png`, {
+        responseType: "blob"
+    });
+
+    // cells are in the order of X-Molecule-Nth, which skips failed molecules
+    const nths: number[] = (r.headers["x-molecule-nth"] || "")
+        .split(",")
+        .filter((n: string) => n !== "")
+        .map(Number);
+
+    const img = await loadImage(r.data);
+    const images = await promise.Promise.all(nths.map((_, i) => cropCell(img, i)));
+    return nths.map((nth, i) => ({ nth, image: images[i] }));
 }
 
 export async function getMol(id: string, nth: number): promise.Promise<Blob> {
@@ -70,8 +70,8 @@ export function fileReducer(state: FileState = initFile, action: Action.FileActi
             break;
 
         case Action.MOL_FETCHED:
-            const newMols: FileState["mols"] = { ...state.mols };
-            newMols[action.nth].mol = action.mol;
+            const newMols: FileState["mols"] = state.mols.slice();
+            newMols[action.nth] = { ...newMols[action.nth], mol: action.mol };
             update = { mols: newMols };
             break;
 
@@ -16,11 +16,36 @@ function* getMolecule() {
         return;
     }
 
+    if (is3D) {
+        try {
+            const blob = yield call(api.getMol, id || "", mol.nth);
+            yield put(Action.MolFetched(current, blob));
+        } catch (e) {
+            yield put(Action.MolFetched(current, null));
+        }
+        return;
+    }
+
+    // the page of molecules around current comes as one grid image
+    const start = Math.floor(mol.nth / api.GRID_COUNT) * api.GRID_COUNT;
+    let cells: api.GridCell[] = [];
     try {
-        const blob = yield call(is3D ? api.getMol : api.getPNG, id || "", current);
-        yield put(Action.MolFetched(current, blob));
+        cells = yield call(api.getGrid, id || "", start);
     } catch (e) {
         yield put(Action.MolFetched(current, null));
+        return;
+    }
+
+    const index: { [nth: number]: number } = {};
+    mols.forEach((m, i) => {
+        index[m.nth] = i;
+    });
+
+    for (const cell of cells) {
+        const i = index[cell.nth];
+        if (i !== undefined && mols[i].mol === undefined) {
+            yield put(Action.MolFetched(i, cell.image));
+        }
     }
 }
 
@@ -27,7 +27,7 @@ export interface FileState {
     gen3D: boolean;
 
     current: number;
-    mols: Array<{ name: string; forcefield?: string; mol?: Blob | null }>;
+    mols: Array<{ name: string; forcefield?: string; nth: number; mol?: Blob | null }>;
 }
 
 export const initFile: FileState = {